@@ -12,6 +12,38 @@ class BotConfig(BaseSettings):
 class AdminSettings(BaseModel):
     admin_ids: list[int]
 
+class PerformanceSettings(BaseModel):
+    candidate_ttl_seconds: int = 900
+    candidate_low_watermark: int = 10
+    http_connections_limit: int = 100
+    http_connections_per_host: int = 16
+    http_dns_cache_ttl: int = 300
+    http_keepalive_timeout: float = 60
+    rule34_count_ttl_seconds: int = 600
+    max_webm_download_mb: int = 200
+    media_cache_max_mb: int = 2048
+    transcode_max_parallel: int = 0
+    transcode_timeout_seconds: float = 600
+    prepare_lead_minutes: int = 5
+    telegram_global_rate: float = 30
+    telegram_chat_rate: float = 1
+    telegram_group_per_minute: float = 20
+    telegram_retry_after_attempts: int = 3
+    e621_requests_per_second: float = 1
+    rule34_requests_per_second: float = 2
+    api_max_in_flight: int = 2
+    posting_jitter_seconds: int = 0
+    dispatcher_workers: int = 8
+    dispatcher_max_backlog: int = 1000
+    dispatcher_misfire_grace_seconds: int = 300
+    page_coverage_ttl_hours: int = 6
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0
+    trace_buffer_size: int = 200
+    log_levels: dict[str, str | int] = {}
+    log_sample_burst: int = 0
+    log_sample_window_seconds: float = 60
+
 def load_admin_config(path: str = "config.yaml") -> AdminSettings:
     try:
         with open(path, 'r') as f:
@@ -30,6 +62,18 @@ def load_admin_config(path: str = "config.yaml") -> AdminSettings:
         logger.error(f"Error parsing configuration file {path}: {e}")
         return AdminSettings(admin_ids=[])
 
+def load_performance_config(path: str = "config.yaml") -> PerformanceSettings:
+    try:
+        with open(path, 'r') as f:
+            config_data = yaml.safe_load(f)
+        # Секция 'performance' необязательна, отсутствующие поля берутся по умолчанию
+        return PerformanceSettings(**((config_data or {}).get('performance') or {}))
+    except FileNotFoundError:
+        return PerformanceSettings()
+    except (yaml.YAMLError, ValidationError) as e:
+        logger.error(f"Error parsing performance settings in {path}: {e}")
+        return PerformanceSettings()
+
 try:
     config = BotConfig()
 except ValidationError as e:
@@ -37,4 +81,5 @@ except ValidationError as e:
     # Provide a default or exit
     config = None # Or handle it as you see fit, maybe exit the application
 
-admin_config = load_admin_config()
\ No newline at end of file
+admin_config = load_admin_config()
+performance_config = load_performance_config()
\ No newline at end of file
@@ -0,0 +1,149 @@
+# app/database/connection.py
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
+import aiosqlite
+
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+)
+
+# Каждая миграция - список SQL-выражений. Номер версии = индекс + 1,
+# текущая версия схемы хранится в PRAGMA user_version.
+MIGRATIONS: List[List[str]] = [
+    [
+        # get_all_active_channels; admin_id уже покрыт первичным ключом (admin_id, channel_id)
+        "CREATE INDEX IF NOT EXISTS idx_channel_settings_is_active ON channel_settings (is_active)",
+    ],
+    [
+        # file_id, который Telegram вернул после первой загрузки поста
+        """
+        CREATE TABLE IF NOT EXISTS telegram_file_cache (
+            api_source TEXT NOT NULL,
+            post_id INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            media_type TEXT NOT NULL,
+            PRIMARY KEY (api_source, post_id)
+        )
+        """,
+    ],
+    [
+        # Самый новый опубликованный id для каналов с приоритетом "newest"
+        "ALTER TABLE channel_settings ADD COLUMN newest_post_id INTEGER",
+    ],
+    [
+        # Индекс по api_source, созданный ранними версиями миграции 1: запросы идут по
+        # первичному ключу (post_id, api_source), а индекс только замедлял вставки
+        "DROP INDEX IF EXISTS idx_posted_media_api_source",
+    ],
+]
+
+
+class ConnectionManager:
+    """Долгоживущие соединения с SQLite: один писатель и небольшой пул читателей."""
+
+    def __init__(self, db_path: str, readers: int = 3, cached_statements: int = 256):
+        self.db_path = db_path
+        self.readers_count = max(1, readers)
+        self.cached_statements = cached_statements
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._reader_queue: Optional[asyncio.Queue] = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        # cached_statements is passed through to sqlite3.connect, so repeated
+        # queries reuse their prepared statements for the connection lifetime.
+        conn = await aiosqlite.connect(self.db_path, cached_statements=self.cached_statements)
+        conn.row_factory = aiosqlite.Row
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self.is_open:
+                return
+            writer = await self._connect()
+            cursor = await writer.execute("PRAGMA journal_mode = WAL")
+            row = await cursor.fetchone()
+            if row and str(row[0]).lower() != "wal":
+                logger.warning(f"SQLite refused WAL mode for {self.db_path}, using '{row[0]}'.")
+            self._writer = writer
+            self._reader_queue = asyncio.Queue()
+            for _ in range(self.readers_count):
+                conn = await self._connect()
+                self._readers.append(conn)
+                self._reader_queue.put_nowait(conn)
+            logger.info(f"Opened SQLite connection pool for {self.db_path} (1 writer, {self.readers_count} readers).")
+
+    async def close(self):
+        async with self._open_lock:
+            for conn in [self._writer, *self._readers]:
+                if conn is None:
+                    continue
+                try:
+                    await conn.close()
+                except aiosqlite.Error as e:
+                    logger.error(f"Failed to close SQLite connection: {e}")
+            self._writer = None
+            self._readers = []
+            self._reader_queue = None
+            logger.info("SQLite connection pool closed.")
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Эксклюзивный доступ к соединению-писателю; коммит при успешном выходе."""
+        if not self.is_open:
+            await self.open()
+        async with self._write_lock:
+            started = time.monotonic()
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            finally:
+                metrics.db_seconds.observe(time.monotonic() - started, "write")
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        if not self.is_open:
+            await self.open()
+        queue = self._reader_queue
+        conn = await queue.get()
+        started = time.monotonic()
+        try:
+            yield conn
+        finally:
+            queue.put_nowait(conn)
+            metrics.db_seconds.observe(time.monotonic() - started, "read")
+
+    async def migrate(self):
+        async with self.writer() as db:
+            cursor = await db.execute("PRAGMA user_version")
+            current = (await cursor.fetchone())[0]
+            for version, statements in enumerate(MIGRATIONS, start=1):
+                if version <= current:
+                    continue
+                for statement in statements:
+                    await db.execute(statement)
+                # PRAGMA does not accept bound parameters
+                await db.execute(f"PRAGMA user_version = {version}")
+                logger.info(f"Applied database migration {version}.")
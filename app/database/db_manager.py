@@ -1,14 +1,22 @@
 import aiosqlite
 import logging
 import json
-from typing import Optional, List, Dict
+import numpy as np
+from typing import Optional, List, Dict, Iterable, Set
+
+from app.database.connection import ConnectionManager
+from app.database.media_index import PostedMediaIndex
 
 logger = logging.getLogger(__name__)
 DB_PATH = "database.db"
 
+db_pool = ConnectionManager(DB_PATH)
+posted_media_index = PostedMediaIndex()
+
 async def init_db():
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        await db_pool.open()
+        async with db_pool.writer() as db:
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS channel_settings (
                     admin_id INTEGER NOT NULL,
@@ -31,24 +39,27 @@ async def init_db():
                     PRIMARY KEY (post_id, api_source)
                 )
             """)
-            await db.commit()
-            logger.info("Database initialized successfully.")
+        await db_pool.migrate()
+        async with db_pool.reader() as db:
+            await posted_media_index.load(db)
+        logger.info("Database initialized successfully.")
     except aiosqlite.Error as e:
         logger.error(f"Database initialization failed: {e}")
 
+async def close_db():
+    await db_pool.close()
+
 async def add_channel(admin_id: int, channel_id: int):
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             await db.execute("INSERT OR IGNORE INTO channel_settings (admin_id, channel_id) VALUES (?, ?)", (admin_id, channel_id))
-            await db.commit()
             logger.info(f"Channel {channel_id} added for admin {admin_id}.")
     except aiosqlite.Error as e:
         logger.error(f"Failed to add channel {channel_id} for admin {admin_id}: {e}")
 
 async def get_channel_settings(admin_id: int, channel_id: int) -> Optional[dict]:
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with db_pool.reader() as db:
             cursor = await db.execute("SELECT * FROM channel_settings WHERE admin_id = ? AND channel_id = ?", (admin_id, channel_id))
             row = await cursor.fetchone()
             if not row:
@@ -65,8 +76,7 @@ async def get_channel_settings(admin_id: int, channel_id: int) -> Optional[dict]
 
 async def get_admin_channels(admin_id: int) -> List[dict]:
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with db_pool.reader() as db:
             cursor = await db.execute("SELECT * FROM channel_settings WHERE admin_id = ?", (admin_id,))
             rows = await cursor.fetchall()
             return [dict(row) for row in rows]
@@ -79,23 +89,25 @@ ALLOWED_COLUMNS = {
     "is_active", "tags_mode", "post_priority", "default_caption"
 }
 
+# Changing any of these makes the stored newest_post_id meaningless for the new search
+QUERY_COLUMNS = {"api_source", "tags", "negative_tags", "tags_mode", "post_priority"}
+
 async def update_channel_setting(admin_id: int, channel_id: int, key: str, value):
     if key not in ALLOWED_COLUMNS:
         logger.error(f"Attempted to update a non-whitelisted column: {key}")
         raise ValueError(f"Invalid setting key: {key}")
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            query = f"UPDATE channel_settings SET {key} = ? WHERE admin_id = ? AND channel_id = ?"
+        async with db_pool.writer() as db:
+            reset = ", newest_post_id = NULL" if key in QUERY_COLUMNS else ""
+            query = f"UPDATE channel_settings SET {key} = ?{reset} WHERE admin_id = ? AND channel_id = ?"
             await db.execute(query, (value, admin_id, channel_id))
-            await db.commit()
             logger.info(f"Setting '{key}' for admin {admin_id} and channel {channel_id} updated to '{value}'.")
     except aiosqlite.Error as e:
         logger.error(f"Failed to update setting '{key}' for admin {admin_id} and channel {channel_id}: {e}")
 
 async def get_all_active_channels() -> List[dict]:
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with db_pool.reader() as db:
             cursor = await db.execute("SELECT * FROM channel_settings WHERE is_active = 1 AND channel_id IS NOT NULL")
             rows = await cursor.fetchall()
             results = []
@@ -109,32 +121,100 @@ async def get_all_active_channels() -> List[dict]:
         logger.error(f"Failed to get all active channels: {e}")
         return []
 
+async def advance_newest_post_id(admin_id: int, channel_id: int, post_id: int):
+    try:
+        async with db_pool.writer() as db:
+            await db.execute(
+                "UPDATE channel_settings SET newest_post_id = MAX(COALESCE(newest_post_id, 0), ?) WHERE admin_id = ? AND channel_id = ?",
+                (post_id, admin_id, channel_id)
+            )
+    except aiosqlite.Error as e:
+        logger.error(f"Failed to update newest post id for admin {admin_id} and channel {channel_id}: {e}")
+
 async def delete_channel(admin_id: int, channel_id: int):
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             await db.execute("DELETE FROM channel_settings WHERE admin_id = ? AND channel_id = ?", (admin_id, channel_id))
-            await db.commit()
             logger.info(f"Channel {channel_id} deleted for admin {admin_id}.")
     except aiosqlite.Error as e:
         logger.error(f"Failed to delete channel {channel_id} for admin {admin_id}: {e}")
 
 async def add_posted_media(post_id: int, api_source: str):
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             await db.execute("INSERT OR IGNORE INTO posted_media (post_id, api_source) VALUES (?, ?)", (post_id, api_source))
-            await db.commit()
+        posted_media_index.add(post_id, api_source)
     except aiosqlite.Error as e:
         logger.error(f"Failed to add posted media (post_id: {post_id}, api_source: {api_source}): {e}")
 
 async def is_media_posted(post_id: int, api_source: str) -> bool:
+    if posted_media_index.loaded:
+        return posted_media_index.contains(post_id, api_source)
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             cursor = await db.execute("SELECT 1 FROM posted_media WHERE post_id = ? AND api_source = ?", (post_id, api_source))
             return await cursor.fetchone() is not None
     except aiosqlite.Error as e:
         logger.error(f"Failed to check if media is posted (post_id: {post_id}, api_source: {api_source}): {e}")
         return False
 
+# SQLite limits the number of bound parameters per statement (999 on older builds)
+IN_QUERY_CHUNK = 900
+
+async def get_posted_media_ids(post_ids: Iterable[int], api_source: str) -> Set[int]:
+    """Возвращает подмножество post_ids, которые уже были опубликованы."""
+    post_ids = list(dict.fromkeys(post_ids))
+    if posted_media_index.loaded:
+        return {post_id for post_id in post_ids if posted_media_index.contains(post_id, api_source)}
+    posted = set()
+    try:
+        async with db_pool.reader() as db:
+            for i in range(0, len(post_ids), IN_QUERY_CHUNK):
+                chunk = post_ids[i:i + IN_QUERY_CHUNK]
+                placeholders = ", ".join("?" for _ in chunk)
+                cursor = await db.execute(
+                    f"SELECT post_id FROM posted_media WHERE api_source = ? AND post_id IN ({placeholders})",
+                    (api_source, *chunk)
+                )
+                posted.update(row[0] for row in await cursor.fetchall())
+    except aiosqlite.Error as e:
+        logger.error(f"Failed to check posted media batch (api_source: {api_source}): {e}")
+    return posted
+
+async def get_posted_mask(post_ids: np.ndarray, api_source: str) -> np.ndarray:
+    """Булева маска уже опубликованных постов для массива post_ids."""
+    if posted_media_index.loaded:
+        return posted_media_index.contains_many(post_ids, api_source)
+    posted = await get_posted_media_ids(post_ids.tolist(), api_source)
+    return np.isin(post_ids, np.fromiter(posted, dtype=np.int64, count=len(posted)))
+
+async def get_cached_file(post_id: int, api_source: str) -> Optional[dict]:
+    try:
+        async with db_pool.reader() as db:
+            cursor = await db.execute("SELECT file_id, media_type FROM telegram_file_cache WHERE api_source = ? AND post_id = ?", (api_source, post_id))
+            row = await cursor.fetchone()
+            return dict(row) if row else None
+    except aiosqlite.Error as e:
+        logger.error(f"Failed to get cached file_id (post_id: {post_id}, api_source: {api_source}): {e}")
+        return None
+
+async def save_cached_file(post_id: int, api_source: str, file_id: str, media_type: str):
+    try:
+        async with db_pool.writer() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO telegram_file_cache (api_source, post_id, file_id, media_type) VALUES (?, ?, ?, ?)",
+                (api_source, post_id, file_id, media_type)
+            )
+    except aiosqlite.Error as e:
+        logger.error(f"Failed to cache file_id (post_id: {post_id}, api_source: {api_source}): {e}")
+
+async def delete_cached_file(post_id: int, api_source: str):
+    try:
+        async with db_pool.writer() as db:
+            await db.execute("DELETE FROM telegram_file_cache WHERE api_source = ? AND post_id = ?", (api_source, post_id))
+    except aiosqlite.Error as e:
+        logger.error(f"Failed to delete cached file_id (post_id: {post_id}, api_source: {api_source}): {e}")
+
 async def backup_settings(admin_id: int) -> str:
     channels = await get_admin_channels(admin_id)
     return json.dumps(channels, indent=4)
@@ -142,7 +222,7 @@ async def backup_settings(admin_id: int) -> str:
 async def restore_settings(admin_id: int, data: str):
     try:
         channels = json.loads(data)
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             for channel in channels:
                 # Basic validation
                 if not all(k in channel for k in ['channel_id', 'api_source', 'tags']):
@@ -157,7 +237,6 @@ async def restore_settings(admin_id: int, data: str):
                 
                 query = f"INSERT OR REPLACE INTO channel_settings ({columns}) VALUES ({placeholders})"
                 await db.execute(query, values)
-            await db.commit()
             logger.info(f"Successfully restored settings for admin {admin_id}.")
     except json.JSONDecodeError as e:
         logger.error(f"JSON decode error during restore for admin {admin_id}: {e}")
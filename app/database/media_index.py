@@ -0,0 +1,86 @@
+# app/database/media_index.py
+import logging
+from typing import Dict, Set
+
+import aiosqlite
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class PostedMediaIndex:
+    """
+    Множество опубликованных постов в памяти: битовая карта по post_id для каждого api_source.
+    Id booru-сайтов плотные и не превышают десятков миллионов, поэтому карта занимает
+    единицы мегабайт и дает точный ответ без обращения к БД.
+    """
+
+    # Ids above this (or negative) go to a plain set instead of growing the bitmap
+    MAX_BITMAP_ID = 1 << 28
+
+    def __init__(self):
+        self._bitmaps: Dict[str, bytearray] = {}
+        self._overflow: Dict[str, Set[int]] = {}
+        self.loaded = False
+
+    def add(self, post_id: int, api_source: str):
+        post_id = int(post_id)
+        if post_id < 0 or post_id >= self.MAX_BITMAP_ID:
+            self._overflow.setdefault(api_source, set()).add(post_id)
+            return
+        bitmap = self._bitmaps.get(api_source)
+        if bitmap is None:
+            bitmap = self._bitmaps[api_source] = bytearray()
+        byte_index = post_id >> 3
+        if byte_index >= len(bitmap):
+            # Grow with headroom so sequential new ids don't reallocate every time
+            new_size = min(max(byte_index + 1, len(bitmap) * 3 // 2), self.MAX_BITMAP_ID >> 3)
+            bitmap.extend(bytes(new_size - len(bitmap)))
+        bitmap[byte_index] |= 1 << (post_id & 7)
+
+    def contains(self, post_id: int, api_source: str) -> bool:
+        post_id = int(post_id)
+        if post_id < 0 or post_id >= self.MAX_BITMAP_ID:
+            return post_id in self._overflow.get(api_source, ())
+        bitmap = self._bitmaps.get(api_source)
+        byte_index = post_id >> 3
+        if bitmap is None or byte_index >= len(bitmap):
+            return False
+        return bool(bitmap[byte_index] & (1 << (post_id & 7)))
+
+    def contains_many(self, post_ids: np.ndarray, api_source: str) -> np.ndarray:
+        """Векторный вариант contains: булев массив той же длины, что post_ids."""
+        post_ids = np.asarray(post_ids, dtype=np.int64)
+        result = np.zeros(post_ids.shape, dtype=bool)
+        in_range = (post_ids >= 0) & (post_ids < self.MAX_BITMAP_ID)
+        bitmap = self._bitmaps.get(api_source)
+        if bitmap:
+            bits = np.frombuffer(bitmap, dtype=np.uint8)
+            byte_index = post_ids >> 3
+            in_bitmap = in_range & (byte_index < bits.size)
+            idx = post_ids[in_bitmap]
+            result[in_bitmap] = (bits[idx >> 3] >> (idx & 7).astype(np.uint8)) & 1 == 1
+        overflow = self._overflow.get(api_source)
+        if overflow and not in_range.all():
+            result[~in_range] = np.isin(post_ids[~in_range], np.fromiter(overflow, dtype=np.int64, count=len(overflow)))
+        return result
+
+    def clear(self):
+        self._bitmaps.clear()
+        self._overflow.clear()
+        self.loaded = False
+
+    async def load(self, db: aiosqlite.Connection, batch_size: int = 10_000):
+        self.clear()
+        cursor = await db.execute("SELECT post_id, api_source FROM posted_media")
+        rows_count = 0
+        while True:
+            rows = await cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for post_id, api_source in rows:
+                if post_id is not None:
+                    self.add(post_id, api_source)
+            rows_count += len(rows)
+        self.loaded = True
+        logger.info(f"Loaded {rows_count} posted media ids into memory index.")
@@ -8,7 +8,6 @@ from aiogram import Router, Bot, F
 from aiogram.types import Message, BufferedInputFile
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from app.services.admin_service import (
     get_channel_settings_service,
@@ -20,12 +19,16 @@ from app.services.admin_service import (
 )
 from app.keyboards.inline import channels_menu, channel_settings_menu, skip_keyboard
 from app.states.admin_states import AdminSettings, WizardStates
+from app.services.dispatcher import PostingDispatcher
 from app.services.scheduler import posting_job, add_posting_job
 from app.services.health_check_service import run_full_health_check
 from app.utils.text_helpers import escape_md_v2
+from app.utils.tracing import tracer
 
 router = Router()
 logger = logging.getLogger(__name__)
+# Telegram's limit is 4096 characters of visible text; the HTML markup only makes the source longer
+SLOW_POSTS_MESSAGE_LIMIT = 4096
 
 async def show_channels_menu(message: Message, admin_id: int, state: FSMContext, bot: Bot):
     try:
@@ -69,7 +72,7 @@ async def command_add_channel_handler(message: Message, state: FSMContext):
     await message.answer("Перешлите любое сообщение из вашего канала или введите его ID.")
 
 @router.message(Command("status"))
-async def command_status_handler(message: Message, scheduler: AsyncIOScheduler):
+async def command_status_handler(message: Message, scheduler: PostingDispatcher):
     admin_id = message.from_user.id
     jobs = scheduler.get_jobs()
     if not jobs:
@@ -133,7 +136,7 @@ async def process_restore_file(message: Message, state: FSMContext, bot: Bot):
         await state.clear()
 
 @router.message(Command("test_post"))
-async def command_test_post_handler(message: Message, bot: Bot, state: FSMContext, scheduler: AsyncIOScheduler):
+async def command_test_post_handler(message: Message, bot: Bot, state: FSMContext, scheduler: PostingDispatcher):
     admin_id = message.from_user.id
     data = await state.get_data()
     channel_id = data.get('channel_id')
@@ -142,15 +145,46 @@ async def command_test_post_handler(message: Message, bot: Bot, state: FSMContex
         return
     
     await message.answer(f"⏳ Выполняю тестовый поиск и отправку поста для канала {channel_id}... Пожалуйста, подождите.")
-    await posting_job(bot, admin_id, channel_id, scheduler)
+    await posting_job(bot, admin_id, channel_id, scheduler, manual=True)
 
 @router.message(Command("health_check"))
-async def command_health_check_handler(message: Message, bot: Bot, scheduler: AsyncIOScheduler):
+async def command_health_check_handler(message: Message, bot: Bot, scheduler: PostingDispatcher):
     from app.services.health_check_service import run_full_health_check
     await message.answer("⏳ Выполняется полная проверка всех систем бота... Результаты будут в логах.")
     await run_full_health_check(bot, scheduler)
     await message.answer("Проверка окончена.")
 
+@router.message(Command("slow_posts"))
+async def command_slow_posts_handler(message: Message):
+    admin_id = message.from_user.id
+    traces = tracer.slowest(5, admin_id=admin_id)
+    if not traces:
+        await message.answer("Пока нет данных о публикациях.")
+        return
+
+    lines = ["🐢 <b>Самые медленные из последних задач:</b>"]
+    for trace in traces:
+        started = datetime.fromtimestamp(trace.started_at).strftime("%Y-%m-%d %H:%M:%S")
+        post_id = trace.attrs.get('post_id', '—')
+        block = ["", f"<b>{trace.duration:.1f} с</b> — {html.escape(trace.name)}, канал <code>{trace.attrs.get('channel_id')}</code>, "
+                     f"пост <code>{post_id}</code>, {html.escape(str(trace.attrs.get('result', '—')))} ({started})"]
+        for path, calls, seconds in trace.breakdown():
+            indent = "  " * len(path)
+            calls_text = f" ×{calls}" if calls > 1 else ""
+            block.append(f"{indent}{html.escape(path[-1])}{calls_text}: {seconds:.1f} с")
+        # Whole lines only: cutting the HTML mid-tag would make Telegram reject the message
+        if len("\n".join(lines + block)) > SLOW_POSTS_MESSAGE_LIMIT:
+            if len(lines) == 1:
+                # Even the slowest trace alone is too long, show as many of its stages as fit
+                for line in block:
+                    if len("\n".join(lines + [line])) > SLOW_POSTS_MESSAGE_LIMIT:
+                        break
+                    lines.append(line)
+            break
+        lines.extend(block)
+
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
 @router.message(AdminSettings.waiting_for_channel)
 async def process_channel_id(message: Message, state: FSMContext, bot: Bot):
     admin_id = message.from_user.id
@@ -193,7 +227,7 @@ async def process_wizard_negative_tags(message: Message, state: FSMContext):
     await message.answer("Шаг 3/4: Введите интервал постинга в минутах (от 5 до 1440).", reply_markup=skip_keyboard("interval"))
 
 @router.message(WizardStates.waiting_for_interval)
-async def process_wizard_interval(message: Message, state: FSMContext, bot: Bot, scheduler: AsyncIOScheduler):
+async def process_wizard_interval(message: Message, state: FSMContext, bot: Bot, scheduler: PostingDispatcher):
     admin_id = message.from_user.id
     data = await state.get_data()
     channel_id = data.get('channel_id')
@@ -244,7 +278,7 @@ async def process_negative_tags_edit(message: Message, state: FSMContext):
     await message.answer(f"Настройки для канала {channel_id}:", reply_markup=channel_settings_menu(settings))
 
 @router.message(AdminSettings.waiting_for_interval)
-async def process_interval_edit(message: Message, state: FSMContext, bot: Bot, scheduler: AsyncIOScheduler):
+async def process_interval_edit(message: Message, state: FSMContext, bot: Bot, scheduler: PostingDispatcher):
     admin_id = message.from_user.id
     data = await state.get_data()
     channel_id = data.get('channel_id')
@@ -289,9 +323,9 @@ async def command_post_with_caption_handler(message: Message, state: FSMContext)
     await message.answer("Введите сообщение для поста. Вы можете использовать плейсхолдеры {{source}} и {{tags}}.")
 
 @router.message(AdminSettings.waiting_for_custom_caption)
-async def process_custom_caption(message: Message, state: FSMContext, bot: Bot, scheduler: AsyncIOScheduler):
+async def process_custom_caption(message: Message, state: FSMContext, bot: Bot, scheduler: PostingDispatcher):
     admin_id = message.from_user.id
     data = await state.get_data()
     channel_id = data.get('channel_id')
     await state.clear()
-    await posting_job(bot, admin_id, channel_id, scheduler, custom_caption=message.text)
+    await posting_job(bot, admin_id, channel_id, scheduler, custom_caption=message.text, manual=True)
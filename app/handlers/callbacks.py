@@ -6,7 +6,6 @@ from aiogram import Router, F, Bot
 from aiogram.types import CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.exceptions import TelegramBadRequest
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from app.keyboards.inline import (
     channels_menu,
@@ -19,6 +18,7 @@ from app.keyboards.inline import (
 )
 from app.services.admin_service import get_channel_settings_service, update_channel_setting_service, get_admin_channels_service, delete_channel_service
 from app.states.admin_states import AdminSettings, WizardStates
+from app.services.dispatcher import PostingDispatcher
 from app.services.scheduler import add_posting_job, remove_posting_job
 from app.keyboards.callback_data import (
     ChannelCallback,
@@ -67,7 +67,7 @@ async def delete_channel_handler(callback: CallbackQuery, callback_data: Channel
     await safe_edit_message(callback, f"Вы уверены, что хотите удалить канал {channel_id}?", reply_markup=confirm_delete_menu(channel_id))
 
 @router.callback_query(ChannelCallback.filter(F.action == "confirm_delete"))
-async def confirm_delete_handler(callback: CallbackQuery, callback_data: ChannelCallback, state: FSMContext, bot: Bot, scheduler: AsyncIOScheduler):
+async def confirm_delete_handler(callback: CallbackQuery, callback_data: ChannelCallback, state: FSMContext, bot: Bot, scheduler: PostingDispatcher):
     await callback.answer()
     channel_id = callback_data.channel_id
     admin_id = callback.from_user.id
@@ -82,7 +82,7 @@ async def confirm_delete_handler(callback: CallbackQuery, callback_data: Channel
     await callback.message.answer("Выберите канал для управления:", reply_markup=await channels_menu(channels, bot))
 
 @router.callback_query(SettingsCallback.filter(F.action.in_(["start", "stop"])))
-async def toggle_status_handler(callback: CallbackQuery, callback_data: SettingsCallback, scheduler: AsyncIOScheduler, bot: Bot):
+async def toggle_status_handler(callback: CallbackQuery, callback_data: SettingsCallback, scheduler: PostingDispatcher, bot: Bot):
     await callback.answer()
     admin_id = callback.from_user.id
     action = callback_data.action
@@ -0,0 +1,104 @@
+# app/middlewares/send_rate_limiter.py
+import logging
+import time
+from typing import Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage,
+    CopyMessages,
+    ForwardMessage,
+    ForwardMessages,
+    SendAnimation,
+    SendAudio,
+    SendDocument,
+    SendMediaGroup,
+    SendMessage,
+    SendPhoto,
+    SendSticker,
+    SendVideo,
+    SendVideoNote,
+    SendVoice,
+    TelegramMethod,
+)
+from aiogram.methods.base import Response, TelegramType
+from cachetools import TTLCache
+
+from app.utils import metrics, tracing
+from app.utils.token_bucket import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED_METHODS = (
+    SendMessage, SendPhoto, SendVideo, SendAnimation, SendDocument, SendAudio, SendVoice,
+    SendVideoNote, SendSticker, SendMediaGroup, CopyMessage, CopyMessages, ForwardMessage, ForwardMessages,
+)
+
+
+class SendRateLimiter(BaseRequestMiddleware):
+    """
+    Единая точка для всех исходящих сообщений бота: общий лимит на бота и лимит на каждый чат.
+    При 429 от Telegram чат ставится на паузу на retry_after и запрос повторяется.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, group_per_minute: float = 20, max_retries: int = 3):
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_per_minute / 60
+        self.max_retries = max_retries
+        self._chat_buckets = TTLCache(maxsize=10_000, ttl=3600)
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Basic groups have plain negative ids; channels and supergroups are -100..., users are positive
+            is_group = isinstance(chat_id, int) and chat_id < 0 and not str(chat_id).startswith("-100")
+            if is_group:
+                bucket = TokenBucket(rate=self.group_rate, capacity=3)
+            else:
+                bucket = TokenBucket(rate=self.chat_rate, capacity=1)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    @staticmethod
+    async def _timed_request(
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = type(method).__name__
+        started = time.monotonic()
+        try:
+            with tracing.span(f"telegram.{name}"):
+                return await make_request(bot, method)
+        except TelegramAPIError as e:
+            metrics.telegram_errors_total.inc(name, type(e).__name__)
+            raise
+        finally:
+            metrics.telegram_request_seconds.observe(time.monotonic() - started, name)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if not isinstance(method, RATE_LIMITED_METHODS):
+            return await self._timed_request(make_request, bot, method)
+
+        chat_id = getattr(method, 'chat_id', None)
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        for attempt in range(self.max_retries + 1):
+            if chat_bucket:
+                await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await self._timed_request(make_request, bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Flood control for chat {chat_id} on {type(method).__name__}: retrying in {e.retry_after}s (attempt {attempt + 1}/{self.max_retries}).")
+                # The next acquire() waits out the pause before retrying
+                (chat_bucket or self.global_bucket).pause(e.retry_after)
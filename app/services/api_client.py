@@ -1,17 +1,30 @@
 # app/services/api_client.py
 import asyncio
 import aiohttp
-import random
+import json
 import logging
-from typing import Optional, Dict, Any, List
+import time
+from datetime import datetime
+from typing import Optional, Dict, Any, List, NamedTuple
 import xml.etree.ElementTree as ET
 import cloudscraper
+from cachetools import TTLCache
+
+from app.config_reader import performance_config
+from app.database.db_manager import get_posted_media_ids
+from app.services.host_limiter import host_limiters
+from app.services.http_client import HEADERS, get_http_session
+from app.services.page_coverage import page_coverage
+from app.services.sampler import CandidatePool
+from app.utils import tracing
 
 logger = logging.getLogger(__name__)
 
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-}
+def _parse_timestamp(value: Optional[str]) -> Optional[float]:
+    try:
+        return datetime.fromisoformat(value).timestamp() if value else None
+    except ValueError:
+        return None
 
 def format_post_e621(post: Dict) -> Optional[Dict]:
     """Вспомогательная функция для унификации ответа от e621."""
@@ -21,7 +34,9 @@ def format_post_e621(post: Dict) -> Optional[Dict]:
             return None
         return {
             "id": post["id"], "url": post["file"]["url"], "ext": post["file"]["ext"],
-            "tags": post["tags"]["general"], "source": f"https://e621.net/posts/{post['id']}"
+            "tags": post["tags"]["general"], "source": f"https://e621.net/posts/{post['id']}",
+            "score": post.get("score", {}).get("total", 0), "api_source": "e621",
+            "md5": post["file"].get("md5"), "created_at": _parse_timestamp(post.get("created_at"))
         }
     except KeyError as e:
         logger.warning(f"Missing key {e} in e621 post: {post}")
@@ -35,139 +50,292 @@ def format_post_rule34(post: Dict) -> Optional[Dict]:
             return None
         return {
             "id": post["id"], "url": post["file_url"], "ext": post["image"].split('.')[-1],
-            "tags": post["tags"].split(), "source": f"https://rule34.xxx/index.php?page=post&s=view&id={post['id']}"
+            "tags": post["tags"].split(), "source": f"https://rule34.xxx/index.php?page=post&s=view&id={post['id']}",
+            "score": post.get("score") or 0, "api_source": "rule34",
+            # The API has no creation time; "change" is the last modification, close enough for ordering
+            "md5": post.get("hash"), "created_at": post.get("change")
         }
     except KeyError as e:
         logger.warning(f"Missing key {e} in rule34 post: {post}")
         return None
 
+# Identical searches running at the same time share one request: (api_source, tags, negative_tags,
+# tags_mode, post_priority) -> task of the request in flight.
+_inflight_searches: Dict[tuple, asyncio.Task] = {}
+
 class BaseApiClient:
+    api_source: str = ""
+
     def __init__(self, session: aiohttp.ClientSession):
         self.session = session
+        # Shared by every client of the same API, so all channels together stay within its limits
+        self.limiter = host_limiters[self.api_source]
 
-    async def get_post(self, tags: str, negative_tags: str, tags_mode: str, post_priority: str) -> Optional[Dict[str, Any]]:
+    @staticmethod
+    def format_tags(tags: str, negative_tags: str, tags_mode: str) -> str:
+        tag_list = [tag.strip() for tag in tags.split(',') if tag.strip()]
+        formatted_tags = ' '.join(f"~{tag}" for tag in tag_list) if tags_mode == 'OR' and len(tag_list) > 1 else ' '.join(tag_list)
+        if negative_tags:
+            formatted_tags += ' ' + ' '.join(f"-{tag.strip()}" for tag in negative_tags.split(','))
+        return formatted_tags
+
+    async def get_posts(self, tags: str, negative_tags: str, tags_mode: str, post_priority: str,
+                        after_id: Optional[int] = None, before_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Возвращает всю страницу результатов поиска в унифицированном формате.
+        after_id/before_id ограничивают выдачу постами новее/старше указанного id.
+        Одинаковые запросы, пришедшие, пока первый еще выполняется, получают его результат.
+        """
+        key = (self.api_source, tags, negative_tags, tags_mode, post_priority, after_id, before_id)
+        task = _inflight_searches.get(key)
+        if task is None:
+            task = asyncio.create_task(self._search(tags, negative_tags, tags_mode, post_priority, after_id, before_id))
+            _inflight_searches[key] = task
+            task.add_done_callback(lambda _: _inflight_searches.pop(key, None))
+        else:
+            logger.info(f"Joining in-flight {self.api_source} search for tags '{tags}'.")
+        # Shielded so one caller being cancelled doesn't cancel the request for the others
+        with tracing.span(f"api_search.{self.api_source}"):
+            posts = await asyncio.shield(task)
+        return list(posts)
+
+    async def _search(self, tags: str, negative_tags: str, tags_mode: str, post_priority: str,
+                      after_id: Optional[int], before_id: Optional[int]) -> List[Dict[str, Any]]:
         raise NotImplementedError
 
+    @classmethod
+    def sampling_priority(cls, post_priority: str) -> str:
+        """Приоритет, с которым взвешивается выборка из загруженных постов (см. CandidatePool.weights)."""
+        return 'random'
+
+    @classmethod
+    def choose_post(cls, posts: List[Dict[str, Any]], post_priority: str) -> Dict[str, Any]:
+        return posts[int(CandidatePool(posts).sample(cls.sampling_priority(post_priority))[0])]
+
+    @tracing.traced("get_post")
+    async def get_post(self, tags: str, negative_tags: str, tags_mode: str, post_priority: str) -> Optional[Dict[str, Any]]:
+        posts = await self.get_posts(tags, negative_tags, tags_mode, post_priority)
+        return self.choose_post(posts, post_priority) if posts else None
+
 class E621Client(BaseApiClient):
+    api_source = "e621"
     API_URL = "https://e621.net/posts.json"
+    # e621 refuses numbered pages past this one
+    MAX_PAGE = 750
     PRIORITY_ORDER_MAP = {
         'random': 'random', 'newest': 'id_desc', 'oldest': 'id_asc',
         'most_popular': 'score_desc', 'least_popular': 'score_asc'
     }
 
-    def _calculate_weights(self, posts: List[Dict], priority: str) -> Optional[List[float]]:
-        try:
-            weight_calculators = {
-                'most_popular': lambda p: max(0, p['score']['total']) + 1,
-                'least_popular': lambda p: 1 / (max(0, p['score']['total']) + 1),
-                'newest': lambda p: p['id'],
-                'oldest': lambda p: 1 / p['id'] if p['id'] > 0 else 1
-            }
-            if priority in weight_calculators:
-                return [weight_calculators[priority](p) for p in posts]
-        except (TypeError, KeyError) as e:
-            logger.error(f"Could not calculate weights due to unexpected post data: {e}")
-            return None
-        return None
+    @classmethod
+    def sampling_priority(cls, post_priority: str) -> str:
+        return post_priority
 
-    async def get_post(self, tags: str, negative_tags: str, tags_mode: str, post_priority: str) -> Optional[Dict[str, Any]]:
-        tag_list = [tag.strip() for tag in tags.split(',') if tag.strip()]
-        formatted_tags = ' '.join(f"~{tag}" for tag in tag_list) if tags_mode == 'OR' and len(tag_list) > 1 else ' '.join(tag_list)
-        if negative_tags:
-            formatted_tags += ' ' + ' '.join(f"-{tag.strip()}" for tag in negative_tags.split(','))
-        
+    async def _search(self, tags: str, negative_tags: str, tags_mode: str, post_priority: str,
+                      after_id: Optional[int], before_id: Optional[int]) -> List[Dict[str, Any]]:
+        formatted_tags = self.format_tags(tags, negative_tags, tags_mode)
         order_tag = self.PRIORITY_ORDER_MAP.get(post_priority, 'random')
         limit = 100
 
-        params = {"tags": f"{formatted_tags} order:{order_tag}", "limit": limit}
+        coverage_key, page = None, None
+        if after_id or before_id:
+            # Id-based pagination (page=a<id>/b<id>) is ordered by id and ignores order: tags
+            params = {"tags": formatted_tags, "limit": limit, "page": f"a{after_id}" if after_id else f"b{before_id}"}
+        else:
+            params = {"tags": f"{formatted_tags} order:{order_tag}", "limit": limit}
+            if order_tag != 'random':
+                # Ordered results always start at the same page: go to the first one that still has unposted posts
+                coverage_key = (self.api_source, formatted_tags, order_tag)
+                page = page_coverage.first_open(coverage_key, 1, self.MAX_PAGE)
+                if page is None:
+                    logger.warning("No posts found from e621 for the given tags.")
+                    return []
+                params["page"] = page
         logger.info(f"Requesting e621 with params: {params}")
         
         try:
-            async with self.session.get(self.API_URL, params=params, headers=HEADERS) as response:
+            async with self.limiter.slot(), self.session.get(self.API_URL, params=params, headers=HEADERS) as response:
+                self.limiter.report(response.status)
                 if response.status != 200:
                     logger.error(f"e621 API returned status {response.status}: {await response.text()}")
-                    return None
+                    return []
                 data = await response.json()
                 
                 raw_posts = data.get("posts", [])
                 if not raw_posts:
+                    if coverage_key:
+                        page_coverage.mark_end(coverage_key, page)
                     logger.warning("No posts found from e621 for the given tags.")
-                    return None
+                    return []
+                posts = [post for post in map(format_post_e621, raw_posts) if post]
+            if coverage_key and posts:
+                posted_ids = await get_posted_media_ids([post['id'] for post in posts], self.api_source)
+                if len(posted_ids) == len(posts):
+                    page_coverage.mark_exhausted(coverage_key, page)
+            return posts
 
-                if post_priority == 'random':
-                    return format_post_e621(random.choice(raw_posts))
-                
-                weights = self._calculate_weights(raw_posts, post_priority)
-                if weights is None:
-                    return format_post_e621(random.choice(raw_posts))
+        except (aiohttp.ClientError, TypeError, KeyError) as e:
+            logger.exception(f"Error in E621Client: {e}")
+            return []
 
-                chosen_post = random.choices(raw_posts, weights=weights, k=1)[0]
-                return format_post_e621(chosen_post)
+class Rule34Response(NamedTuple):
+    status: int
+    content_type: str
+    text: str
 
-        except (aiohttp.ClientError, IndexError, TypeError, KeyError) as e:
-            logger.exception(f"Error in E621Client: {e}")
-            return None
+# Cloudscraper is only needed when rule34 serves a Cloudflare challenge; it is created
+# on first use and shared by all clients, its blocking requests run in a worker thread.
+_scraper = None
+_challenge_until = 0.0
+CHALLENGE_BYPASS_SECONDS = 600
+
+def _get_scraper():
+    global _scraper
+    if _scraper is None:
+        logger.info("Creating shared cloudscraper session for Rule34 challenge fallback.")
+        _scraper = cloudscraper.create_scraper()
+    return _scraper
+
+def _is_challenge(status: int, headers, text: str) -> bool:
+    if status not in (403, 429, 503):
+        return False
+    server = headers.get('Server', '').lower()
+    return 'cloudflare' in server or 'cf-mitigated' in headers or 'Just a moment' in text or 'cf-chl' in text
+
+# formatted tags -> (count, fetched_at). Entries older than the TTL are still served
+# while a background refresh runs; the cache itself drops them after 4x the TTL.
+RULE34_COUNT_TTL = performance_config.rule34_count_ttl_seconds
+_count_cache = TTLCache(maxsize=4096, ttl=RULE34_COUNT_TTL * 4)
+_count_refresh_tasks: Dict[str, asyncio.Task] = {}
 
 class Rule34Client(BaseApiClient):
+    api_source = "rule34"
     API_URL = "https://api.rule34.xxx/index.php"
+    # The API serves at most 200000 results, i.e. pid 0..1999 at 100 per page
+    MAX_PID = 1999
 
-    def __init__(self, session: aiohttp.ClientSession):
-        super().__init__(session)
-        self.scraper = cloudscraper.create_scraper()
+    async def _fetch_with_scraper(self, params: Dict[str, Any]) -> Rule34Response:
+        def _get_request():
+            return _get_scraper().get(self.API_URL, params=params, headers=HEADERS)
 
-    async def get_post(self, tags: str, negative_tags: str, tags_mode: str, post_priority: str) -> Optional[Dict[str, Any]]:
-        tag_list = [tag.strip() for tag in tags.split(',') if tag.strip()]
-        formatted_tags = ' '.join(f"~{tag}" for tag in tag_list) if tags_mode == 'OR' and len(tag_list) > 1 else ' '.join(tag_list)
-        if negative_tags:
-            formatted_tags += ' ' + ' '.join(f"-{tag.strip()}" for tag in negative_tags.split(','))
+        try:
+            response = await asyncio.to_thread(_get_request)
+        except Exception as e:
+            raise aiohttp.ClientError(f"cloudscraper request failed: {e}") from e
+        return Rule34Response(response.status_code, response.headers.get('Content-Type', ''), response.text)
 
-        logger.info(f"Requesting Rule34 with tags: {formatted_tags}")
+    async def _fetch(self, params: Dict[str, Any]) -> Rule34Response:
+        async with self.limiter.slot():
+            response = await self._fetch_unlimited(params)
+        self.limiter.report(response.status)
+        return response
+
+    async def _fetch_unlimited(self, params: Dict[str, Any]) -> Rule34Response:
+        global _challenge_until
+        if time.monotonic() < _challenge_until:
+            return await self._fetch_with_scraper(params)
 
-        def _get_request(url, params):
-            return self.scraper.get(url, params=params, headers=HEADERS)
+        async with self.session.get(self.API_URL, params=params, headers=HEADERS) as response:
+            text = await response.text()
+            if not _is_challenge(response.status, response.headers, text):
+                return Rule34Response(response.status, response.headers.get('Content-Type', ''), text)
 
+        logger.warning(f"Rule34 returned a Cloudflare challenge (status {response.status}), falling back to cloudscraper.")
+        _challenge_until = time.monotonic() + CHALLENGE_BYPASS_SECONDS
+        return await self._fetch_with_scraper(params)
+
+    async def _fetch_total_posts(self, formatted_tags: str) -> Optional[int]:
+        count_params = {"page": "dapi", "s": "post", "q": "index", "tags": formatted_tags, "limit": 0}
+        response = await self._fetch(count_params)
+        if response.status != 200:
+            logger.error(f"Rule34 API returned status {response.status}: {response.text[:500]}")
+            return None
         try:
-            count_params = {"page": "dapi", "s": "post", "q": "index", "tags": formatted_tags, "limit": 0}
-            total_posts = 0
-            
-            response = await asyncio.to_thread(_get_request, self.API_URL, count_params)
-            response.raise_for_status()
             root = ET.fromstring(response.text)
-            total_posts = int(root.get('count', 0))
+        except ET.ParseError as e:
+            logger.error(f"Failed to parse XML from Rule34: {e}. Response text: {response.text}")
+            return None
+        total_posts = int(root.get('count', 0))
+        _count_cache[formatted_tags] = (total_posts, time.monotonic())
+        return total_posts
 
-            if total_posts == 0:
-                logger.warning("No posts found from Rule34 for the given tags.")
-                return None
-            
+    async def _refresh_total_posts(self, formatted_tags: str):
+        try:
+            await self._fetch_total_posts(formatted_tags)
+        except Exception as e:
+            logger.error(f"Background refresh of Rule34 post count for '{formatted_tags}' failed: {e}")
+        finally:
+            _count_refresh_tasks.pop(formatted_tags, None)
+
+    async def get_total_posts(self, formatted_tags: str) -> Optional[int]:
+        """Количество постов по запросу из кэша; устаревшее значение обновляется в фоне."""
+        cached = _count_cache.get(formatted_tags)
+        if cached is None:
+            return await self._fetch_total_posts(formatted_tags)
+        total_posts, fetched_at = cached
+        if time.monotonic() - fetched_at > RULE34_COUNT_TTL and formatted_tags not in _count_refresh_tasks:
+            _count_refresh_tasks[formatted_tags] = asyncio.create_task(self._refresh_total_posts(formatted_tags))
+        return total_posts
+
+    async def _search(self, tags: str, negative_tags: str, tags_mode: str, post_priority: str,
+                      after_id: Optional[int], before_id: Optional[int]) -> List[Dict[str, Any]]:
+        formatted_tags = self.format_tags(tags, negative_tags, tags_mode)
+        if after_id:
+            # Ascending, so a backlog larger than one page is walked through without gaps
+            formatted_tags += f" id:>{after_id} sort:id:asc"
+        if before_id:
+            formatted_tags += f" id:<{before_id}"
+        logger.info(f"Requesting Rule34 with tags: {formatted_tags}")
+
+        try:
             limit_per_page = 100
-            max_pid = min(total_posts, 200000)
             pid = 0
-            if post_priority != 'newest' and max_pid > 0:
-                pid = random.randint(0, (max_pid - 1) // limit_per_page)
+            # The first page of an id-ordered search needs no post count
+            if post_priority != 'newest':
+                total_posts = await self.get_total_posts(formatted_tags)
+                if total_posts is None:
+                    return []
+
+                if total_posts == 0:
+                    logger.warning("No posts found from Rule34 for the given tags.")
+                    return []
 
+                coverage_key = (self.api_source, formatted_tags)
+                pid = page_coverage.choose_random(coverage_key, total_posts, self.MAX_PID + 1)
 
             post_params = {"page": "dapi", "s": "post", "q": "index", "json": "1", "tags": formatted_tags, "limit": limit_per_page, "pid": pid}
             
-            response = await asyncio.to_thread(_get_request, self.API_URL, post_params)
-            response.raise_for_status()
-            if 'application/json' not in response.headers.get('Content-Type', ''):
+            response = await self._fetch(post_params)
+            if response.status != 200:
+                logger.error(f"Rule34 API returned status {response.status}: {response.text[:500]}")
+                return []
+            if 'application/json' not in response.content_type:
                 logger.error(f"Rule34 returned non-JSON response: {response.text}")
-                return None
-            posts = response.json()
-            return format_post_rule34(random.choice(posts)) if posts else None
+                return []
+            posts = json.loads(response.text) if response.text.strip() else []
+            posts = [post for post in map(format_post_rule34, posts or []) if post]
+            if post_priority != 'newest' and posts:
+                posted_ids = await get_posted_media_ids([post['id'] for post in posts], self.api_source)
+                if len(posted_ids) == len(posts):
+                    page_coverage.mark_exhausted(coverage_key, pid, total_posts)
+            return posts
 
         except aiohttp.ClientConnectorError as e:
             logger.error(f"Network connection error in Rule34Client: {e}")
-            return None
-        except ET.ParseError as e:
-            logger.error(f"Failed to parse XML from Rule34: {e}. Response text: {response.text}")
-            return None
-        except (aiohttp.ClientError, IndexError, KeyError, ValueError) as e:
+            return []
+        except (aiohttp.ClientError, asyncio.TimeoutError, IndexError, KeyError, ValueError) as e:
             logger.exception(f"An error occurred in Rule34Client: {e}")
-            return None
+            return []
+
+API_CLIENTS = {'e621': E621Client, 'rule34': Rule34Client}
+
+def get_api_client_class(api_source: str) -> type:
+    if api_source not in API_CLIENTS:
+        logger.error(f"Unknown API source requested: {api_source}")
+        raise ValueError("Unknown API source")
+    return API_CLIENTS[api_source]
 
-def get_api_client(api_source: str, session: aiohttp.ClientSession) -> BaseApiClient:
-    if api_source == 'e621': return E621Client(session)
-    elif api_source == 'rule34': return Rule34Client(session)
-    logger.error(f"Unknown API source requested: {api_source}")
-    raise ValueError("Unknown API source")
\ No newline at end of file
+def get_api_client(api_source: str, session: Optional[aiohttp.ClientSession] = None) -> BaseApiClient:
+    if session is None:
+        session = get_http_session()
+    return get_api_client_class(api_source)(session)
\ No newline at end of file
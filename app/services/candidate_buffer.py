@@ -0,0 +1,147 @@
+# app/services/candidate_buffer.py
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from cachetools import TTLCache
+
+from app.config_reader import performance_config
+from app.database.db_manager import get_posted_mask
+from app.services.sampler import CandidatePool
+
+logger = logging.getLogger(__name__)
+
+QueryKey = Tuple[str, str, str, str, str]
+Fetcher = Callable[[], Awaitable[List[Dict[str, Any]]]]
+
+# Entries of queries no channel has asked for this long are dropped; longer than the longest posting interval
+IDLE_EVICT_SECONDS = 2 * 24 * 3600
+# Refreshes only add pages, so the oldest candidates beyond this many are dropped
+MAX_CANDIDATES = 1000
+
+
+def query_key(channel_settings: Dict) -> QueryKey:
+    return (
+        channel_settings['api_source'],
+        channel_settings['tags'],
+        channel_settings['negative_tags'],
+        channel_settings.get('tags_mode', 'AND'),
+        channel_settings.get('post_priority', 'random'),
+    )
+
+
+class _BufferEntry:
+    def __init__(self):
+        self.pool = CandidatePool()
+        self.fetched_at = 0.0
+        self.used_at = 0.0
+        self.refill_task: Optional[asyncio.Task] = None
+        # Set once a background refill brings nothing new (e.g. a fixed "newest" page),
+        # further refills then wait for the page to go stale.
+        self.source_drained = False
+
+
+class CandidateBuffer:
+    """
+    Неопубликованные посты с последних загруженных страниц для каждого поискового запроса.
+    Каналы с одинаковыми настройками поиска разбирают один и тот же буфер.
+    """
+
+    def __init__(self, ttl: float, low_watermark: int):
+        self.ttl = ttl
+        self.low_watermark = low_watermark
+        self._entries: Dict[QueryKey, _BufferEntry] = {}
+        # Posts handed out but not yet recorded in posted_media, so a refill
+        # can't give the same post to another channel while it is being sent.
+        self._taken = TTLCache(maxsize=10_000, ttl=3600)
+
+    def _prune_idle(self, now: float):
+        expired = [
+            key for key, entry in self._entries.items()
+            if now - entry.used_at > IDLE_EVICT_SECONDS and not (entry.refill_task and not entry.refill_task.done())
+        ]
+        for key in expired:
+            del self._entries[key]
+
+    async def _store(self, key: QueryKey, entry: _BufferEntry, posts: List[Dict[str, Any]]) -> int:
+        if not posts:
+            return 0
+        api_source = key[0]
+        pool = entry.pool
+        ids = np.fromiter((post['id'] for post in posts), dtype=np.int64, count=len(posts))
+        skip = await get_posted_mask(ids, api_source)
+        skip |= np.isin(ids, pool.ids[pool.alive])
+        # Duplicates within the page itself
+        _, first = np.unique(ids, return_index=True)
+        duplicate = np.ones(len(ids), dtype=bool)
+        duplicate[first] = False
+        skip |= duplicate
+        new_posts = [post for post, skipped in zip(posts, skip) if not skipped and (api_source, post['id']) not in self._taken]
+        pool.extend(new_posts)
+        trimmed = pool.trim(MAX_CANDIDATES)
+        if trimmed:
+            logger.debug(f"Dropped {trimmed} oldest candidates of query {key} to stay within {MAX_CANDIDATES}.")
+        entry.fetched_at = time.monotonic()
+        return len(new_posts)
+
+    async def _refill(self, key: QueryKey, entry: _BufferEntry, fetcher: Fetcher):
+        try:
+            if not await self._store(key, entry, await fetcher()):
+                entry.source_drained = True
+            logger.info(f"Background refill for query {key} done, {len(entry.pool)} candidates buffered.")
+        except Exception as e:
+            logger.error(f"Background refill for query {key} failed: {e}")
+        finally:
+            # Even a failed or empty refresh counts, so a stale page isn't refetched on every pop
+            entry.fetched_at = time.monotonic()
+
+    async def pop(self, key: QueryKey, fetcher: Fetcher, priority: str) -> Optional[Dict[str, Any]]:
+        """
+        Выдает непубликовавшийся пост из буфера, при необходимости загружая новую страницу.
+        Пост выбирается с весами по priority (см. CandidatePool.weights). Устаревшая страница
+        не выбрасывается: посты из нее выдаются дальше, а новая загружается в фоне, когда
+        кандидатов становится мало (для "newest" - сразу, чтобы не пропускать новые посты).
+        """
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is None:
+            self._prune_idle(now)
+            entry = self._entries[key] = _BufferEntry()
+        entry.used_at = now
+
+        pool = entry.pool
+        if len(pool):
+            # Another channel may have posted one of these since they were buffered
+            pool.discard(await get_posted_mask(pool.ids, key[0]))
+
+        if not len(pool):
+            if entry.refill_task and not entry.refill_task.done():
+                await asyncio.shield(entry.refill_task)
+            if not len(pool):
+                await self._store(key, entry, await fetcher())
+
+        chosen = pool.sample(priority)
+        if not chosen.size:
+            return None
+
+        post = pool.take(int(chosen[0]))
+        self._taken[(key[0], post['id'])] = None
+
+        refill_running = entry.refill_task and not entry.refill_task.done()
+        low = len(pool) < self.low_watermark
+        stale = time.monotonic() - entry.fetched_at > self.ttl
+        if stale and (low or key[4] == 'newest'):
+            # The page may have new posts by now, so give a drained source another try
+            entry.source_drained = False
+            low = True
+        if low and not refill_running and not entry.source_drained:
+            entry.refill_task = asyncio.create_task(self._refill(key, entry, fetcher))
+        return post
+
+
+candidate_buffer = CandidateBuffer(
+    ttl=performance_config.candidate_ttl_seconds,
+    low_watermark=performance_config.candidate_low_watermark,
+)
@@ -0,0 +1,302 @@
+# app/services/dispatcher.py
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from app.config_reader import performance_config
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+KIND_POSTING = "posting"
+KIND_PREPARE = "prepare"
+
+
+@dataclass
+class DispatcherJob:
+    id: str
+    func: Callable[..., Awaitable[Any]]
+    args: Tuple
+    admin_id: int
+    kind: str
+    next_run_time: Optional[datetime]
+    interval: Optional[timedelta] = None
+    start_date: Optional[datetime] = None
+    jitter: float = 0
+    # Bumped on every reschedule so stale heap entries can be recognized and skipped
+    version: int = 0
+    queued: bool = False
+    running: bool = False
+    runs: int = 0
+
+
+@dataclass(order=True)
+class _HeapEntry:
+    due: datetime
+    seq: int
+    job_id: str = field(compare=False)
+    version: int = field(compare=False)
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class PostingDispatcher:
+    """
+    Единый планировщик для всех каналов: очередь задач по времени запуска и ограниченный
+    пул исполнителей. Готовые к запуску задачи раздаются администраторам по кругу, чтобы
+    один администратор с сотней каналов не задерживал остальных. Пропущенные запуски
+    схлопываются в один, просроченные дольше misfire_grace - пропускаются, а при
+    переполнении очереди в первую очередь отбрасывается необязательная подготовка постов.
+
+    Повторяет ту часть интерфейса APScheduler, которой пользуются обработчики:
+    get_job, get_jobs, remove_job, running, start и shutdown.
+    """
+
+    def __init__(self, workers: int, max_backlog: int, misfire_grace: float):
+        self.workers_count = max(1, workers)
+        self.max_backlog = max_backlog
+        self.misfire_grace = timedelta(seconds=misfire_grace)
+        self._jobs: Dict[str, DispatcherJob] = {}
+        self._heap: List[_HeapEntry] = []
+        self._seq = itertools.count()
+        # admin_id -> ready posting runs; served round-robin across admins
+        self._ready: Dict[int, Deque[Tuple[DispatcherJob, datetime]]] = {}
+        self._ready_admins: Deque[int] = deque()
+        self._ready_prepare: Deque[Tuple[DispatcherJob, datetime]] = deque()
+        self._has_ready: Optional[asyncio.Event] = None
+        self._running = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._workers: List[asyncio.Task] = []
+        self._stats = {"runs": 0, "failed": 0, "misfired": 0, "coalesced": 0, "overruns": 0, "shed": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._loop_task is not None and not self._loop_task.done()
+
+    # --- Job management ---
+
+    def add_interval_job(self, job_id: str, func: Callable[..., Awaitable[Any]], args: Tuple, admin_id: int,
+                         interval: timedelta, start_date: datetime, jitter: float = 0) -> DispatcherJob:
+        """Добавляет или перепланирует периодическую задачу; запуски выровнены по start_date."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = DispatcherJob(job_id, func, args, admin_id, KIND_POSTING, None)
+            self._jobs[job_id] = job
+        job.func, job.args = func, args
+        job.interval, job.start_date, job.jitter = interval, start_date, jitter
+        self._schedule(job, self._next_interval_time(job, _utcnow()))
+        return job
+
+    def add_date_job(self, job_id: str, func: Callable[..., Awaitable[Any]], args: Tuple, admin_id: int,
+                     run_date: datetime) -> DispatcherJob:
+        """Добавляет однократную задачу, заменяя задачу с тем же id."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = DispatcherJob(job_id, func, args, admin_id, KIND_PREPARE, None)
+            self._jobs[job_id] = job
+        job.func, job.args = func, args
+        self._schedule(job, run_date)
+        return job
+
+    def get_job(self, job_id: str) -> Optional[DispatcherJob]:
+        return self._jobs.get(job_id)
+
+    def get_jobs(self) -> List[DispatcherJob]:
+        return sorted(self._jobs.values(), key=lambda j: j.next_run_time or datetime.max.replace(tzinfo=timezone.utc))
+
+    def remove_job(self, job_id: str):
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            # Heap entries are dropped lazily when their version no longer matches
+            job.version += 1
+            job.next_run_time = None
+        # A fired date job is no longer in _jobs, but its run may still wait for a worker
+        self._drop_queued(job_id)
+
+    def _drop_queued(self, job_id: str):
+        """Убирает из очереди уже готовые запуски задачи, чтобы удаленная задача не выполнилась."""
+        for run in self._ready_prepare:
+            if run[0].id == job_id:
+                run[0].queued = False
+        self._ready_prepare = deque(run for run in self._ready_prepare if run[0].id != job_id)
+        for admin_id in list(self._ready):
+            runs = self._ready[admin_id]
+            for run in runs:
+                if run[0].id == job_id:
+                    run[0].queued = False
+            runs = self._ready[admin_id] = deque(run for run in runs if run[0].id != job_id)
+            if not runs:
+                del self._ready[admin_id]
+                self._ready_admins.remove(admin_id)
+
+    def _schedule(self, job: DispatcherJob, due: datetime):
+        job.version += 1
+        job.next_run_time = due
+        heapq.heappush(self._heap, _HeapEntry(due, next(self._seq), job.id, job.version))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    @staticmethod
+    def _next_interval_time(job: DispatcherJob, after: datetime) -> datetime:
+        periods = (after - job.start_date) // job.interval + 1
+        due = job.start_date + job.interval * max(0, periods)
+        if job.jitter:
+            due += timedelta(seconds=random.uniform(0, job.jitter))
+        return due
+
+    # --- Lifecycle ---
+
+    def start(self):
+        if self.running:
+            return
+        self._has_ready = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._loop_task = asyncio.create_task(self._dispatch_loop())
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.workers_count)]
+        logger.info(f"Posting dispatcher started with {self.workers_count} workers and {len(self._jobs)} jobs.")
+
+    async def shutdown(self):
+        tasks = [t for t in [self._loop_task, *self._workers] if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop_task = None
+        self._workers = []
+        logger.info("Posting dispatcher stopped.")
+
+    # --- Dispatching ---
+
+    async def _dispatch_loop(self):
+        while True:
+            self._wakeup.clear()
+            now = _utcnow()
+            while self._heap and self._heap[0].due <= now:
+                entry = heapq.heappop(self._heap)
+                job = self._jobs.get(entry.job_id)
+                if job is None or job.version != entry.version:
+                    continue
+                self._fire(job, entry.due, now)
+
+            timeout = (self._heap[0].due - now).total_seconds() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, job: DispatcherJob, due: datetime, now: datetime):
+        if job.interval is not None:
+            # Coalesce: however many ticks were missed, the job runs at most once now
+            missed = (now - due) // job.interval
+            if missed:
+                self._stats["coalesced"] += missed
+            self._schedule(job, self._next_interval_time(job, now))
+        else:
+            del self._jobs[job.id]
+            job.next_run_time = None
+
+        if now - due > self.misfire_grace:
+            self._stats["misfired"] += 1
+            logger.warning(f"Job {job.id} missed its run time {due:%H:%M:%S} by {(now - due).total_seconds():.0f}s, skipping.")
+            return
+        if job.queued or job.running:
+            self._stats["overruns"] += 1
+            logger.warning(f"Job {job.id} is still {'running' if job.running else 'queued'}, skipping the run due at {due:%H:%M:%S}.")
+            return
+        self._enqueue(job, due)
+
+    def _backlog(self) -> int:
+        return sum(len(runs) for runs in self._ready.values()) + len(self._ready_prepare)
+
+    def _enqueue(self, job: DispatcherJob, due: datetime):
+        backlog = self._backlog()
+        if backlog >= self.max_backlog:
+            if job.kind == KIND_PREPARE or not self._shed_prepare():
+                self._stats["shed"] += 1
+                logger.warning(f"Dispatcher backlog is full ({backlog} runs), dropping the run of {job.id}.")
+                return
+        job.queued = True
+        if job.kind == KIND_PREPARE:
+            self._ready_prepare.append((job, due))
+        else:
+            if job.admin_id not in self._ready:
+                self._ready[job.admin_id] = deque()
+                self._ready_admins.append(job.admin_id)
+            self._ready[job.admin_id].append((job, due))
+        self._has_ready.set()
+
+    def _shed_prepare(self) -> bool:
+        """Освобождает место под публикацию, отбрасывая самую старую подготовку поста."""
+        if not self._ready_prepare:
+            return False
+        job, _ = self._ready_prepare.popleft()
+        job.queued = False
+        self._stats["shed"] += 1
+        logger.warning(f"Dispatcher backlog is full, dropping the preparation run of {job.id}.")
+        return True
+
+    def _take(self) -> Tuple[DispatcherJob, datetime]:
+        # Scheduled posts go first, one per admin in turn; preparations fill idle workers
+        if self._ready_admins:
+            admin_id = self._ready_admins.popleft()
+            runs = self._ready[admin_id]
+            run = runs.popleft()
+            if runs:
+                self._ready_admins.append(admin_id)
+            else:
+                del self._ready[admin_id]
+            return run
+        return self._ready_prepare.popleft()
+
+    async def _worker(self, worker_id: int):
+        while True:
+            await self._has_ready.wait()
+            if not self._backlog():
+                self._has_ready.clear()
+                continue
+            job, due = self._take()
+            job.queued = False
+            lateness = _utcnow() - due
+            metrics.scheduler_lag_seconds.observe(lateness.total_seconds())
+            if lateness > self.misfire_grace:
+                self._stats["misfired"] += 1
+                logger.warning(f"Job {job.id} waited {lateness.total_seconds():.0f}s for a free worker, skipping.")
+                continue
+            job.running = True
+            self._running += 1
+            try:
+                await job.func(*job.args)
+                self._stats["runs"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._stats["failed"] += 1
+                logger.exception(f"Dispatcher worker {worker_id} failed on job {job.id}: {e}")
+            finally:
+                job.running = False
+                job.runs += 1
+                self._running -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "jobs": len(self._jobs),
+            "ready": self._backlog(),
+            "running": self._running,
+            "workers": self.workers_count,
+            **self._stats,
+        }
+
+
+dispatcher = PostingDispatcher(
+    workers=performance_config.dispatcher_workers,
+    max_backlog=performance_config.dispatcher_max_backlog,
+    misfire_grace=performance_config.dispatcher_misfire_grace_seconds,
+)
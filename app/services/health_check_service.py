@@ -3,9 +3,7 @@ import asyncio
 import logging
 import os
 from pathlib import Path
-import aiohttp
 from aiogram import Bot
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from app.database.db_manager import (
     get_all_active_channels,
@@ -16,15 +14,19 @@ from app.database.db_manager import (
     restore_settings,
     backup_settings
 )
-from app.services.api_client import E621Client, Rule34Client, HEADERS
+from app.services.api_client import E621Client, Rule34Client
+from app.services.dispatcher import PostingDispatcher
+from app.services.host_limiter import host_limiters
+from app.services.http_client import get_http_session
 from app.services.scheduler import check_dependencies
+from app.services.transcoder import transcoder
 
 logger = logging.getLogger(__name__)
 TEMP_DIR = Path("temp_media")
 TEST_ADMIN_ID = -1 # Специальный ID для тестовых данных
 TEST_CHANNEL_ID = -1337 # Специальный ID для тестового канала
 
-async def run_full_health_check(bot: Bot, scheduler: AsyncIOScheduler):
+async def run_full_health_check(bot: Bot, scheduler: PostingDispatcher):
     """
     Запускает комплексную проверку состояния бота в тихом режиме, логируя все шаги.
     """
@@ -41,20 +43,20 @@ async def run_full_health_check(bot: Bot, scheduler: AsyncIOScheduler):
         logger.error(f"Health Check FAIL: Database connection: {e}")
 
     # 1.2. API Connectivity Check
-    async with aiohttp.ClientSession(headers=HEADERS, timeout=aiohttp.ClientTimeout(total=15)) as session:
-        try:
-            e621_client = E621Client(session)
-            await e621_client.get_post("cat", "", "AND", "random")
-            logger.info("Health Check: E621 API connection successful.")
-        except Exception as e:
-            logger.error(f"Health Check FAIL: E621 API connection: {e}")
-
-        try:
-            rule34_client = Rule34Client(session)
-            await rule34_client.get_post("cat", "", "AND", "random")
-            logger.info("Health Check: Rule34 API connection successful.")
-        except Exception as e:
-            logger.error(f"Health Check FAIL: Rule34 API connection: {e}")
+    session = get_http_session()
+    try:
+        e621_client = E621Client(session)
+        await asyncio.wait_for(e621_client.get_post("cat", "", "AND", "random"), timeout=15)
+        logger.info("Health Check: E621 API connection successful.")
+    except Exception as e:
+        logger.error(f"Health Check FAIL: E621 API connection: {e}")
+
+    try:
+        rule34_client = Rule34Client(session)
+        await asyncio.wait_for(rule34_client.get_post("cat", "", "AND", "random"), timeout=15)
+        logger.info("Health Check: Rule34 API connection successful.")
+    except Exception as e:
+        logger.error(f"Health Check FAIL: Rule34 API connection: {e}")
 
     # 1.3. Dependencies Check
     try:
@@ -65,11 +67,24 @@ async def run_full_health_check(bot: Bot, scheduler: AsyncIOScheduler):
 
     # 1.4. Scheduler Status
     try:
-        logger.info(f"Health Check: Scheduler is {'running' if scheduler.running else 'stopped'} with {len(scheduler.get_jobs())} jobs.")
+        logger.info(f"Health Check: Scheduler is {'running' if scheduler.running else 'stopped'} with {len(scheduler.get_jobs())} jobs. Stats: {scheduler.stats()}")
     except Exception as e:
         logger.error(f"Health Check FAIL: Scheduler status check: {e}")
 
-    # 1.5. Filesystem Permissions
+    # 1.5. Transcoding Queue
+    try:
+        logger.info(f"Health Check: Transcoding queue stats: {transcoder.stats()}")
+    except Exception as e:
+        logger.error(f"Health Check FAIL: Transcoding queue stats: {e}")
+
+    # 1.6. API Rate Limiters
+    try:
+        for name, limiter in host_limiters.items():
+            logger.info(f"Health Check: {name} rate limiter stats: {limiter.stats()}")
+    except Exception as e:
+        logger.error(f"Health Check FAIL: API rate limiter stats: {e}")
+
+    # 1.7. Filesystem Permissions
     try:
         test_file = TEMP_DIR / "health_check.tmp"
         test_file.touch()
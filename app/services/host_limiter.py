@@ -0,0 +1,78 @@
+# app/services/host_limiter.py
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+
+from app.config_reader import performance_config
+from app.utils import metrics
+from app.utils.token_bucket import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_STATUSES = (429, 503)
+BACKOFF_INITIAL_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 120.0
+
+
+class HostLimiter:
+    """
+    Общий для всех каналов лимит запросов к одному API: частота (ведро токенов) и число
+    одновременных запросов. Ответы 429/503 ставят хост на паузу с экспоненциальным ростом.
+    """
+
+    def __init__(self, name: str, rate: float, max_in_flight: int):
+        self.name = name
+        self.bucket = TokenBucket(rate=rate, capacity=max(1.0, rate))
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self._backoff = 0.0
+        self._stats = {"requests": 0, "throttled": 0, "backoffs": 0, "wait_seconds_total": 0.0, "max_wait_seconds": 0.0}
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        started = time.monotonic()
+        async with self._semaphore:
+            await self.bucket.acquire()
+            wait = time.monotonic() - started
+            self._stats["requests"] += 1
+            self._stats["wait_seconds_total"] += wait
+            self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], wait)
+            if wait > 1:
+                self._stats["throttled"] += 1
+                logger.debug(f"Request to {self.name} waited {wait:.1f}s for the rate limiter.")
+            metrics.api_wait_seconds.observe(wait, self.name)
+            request_started = time.monotonic()
+            try:
+                yield
+            finally:
+                metrics.api_request_seconds.observe(time.monotonic() - request_started, self.name)
+
+    def report(self, status: int):
+        """Учитывает статус ответа: 429/503 включают паузу, успешный ответ ее сбрасывает."""
+        metrics.api_requests_total.inc(self.name, status)
+        if status in BACKOFF_STATUSES:
+            self._backoff = min(BACKOFF_MAX_SECONDS, self._backoff * 2 or BACKOFF_INITIAL_SECONDS)
+            self._stats["backoffs"] += 1
+            self.bucket.pause(self._backoff)
+            logger.warning(f"{self.name} answered {status}, pausing requests for {self._backoff:.0f}s.")
+        elif status < 400:
+            self._backoff = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        requests = self._stats["requests"]
+        return {
+            "requests": requests,
+            "throttled": self._stats["throttled"],
+            "backoffs": self._stats["backoffs"],
+            "avg_wait_seconds": self._stats["wait_seconds_total"] / requests if requests else 0.0,
+            "max_wait_seconds": self._stats["max_wait_seconds"],
+            "current_backoff_seconds": self._backoff,
+        }
+
+
+host_limiters: Dict[str, HostLimiter] = {
+    "e621": HostLimiter("e621", performance_config.e621_requests_per_second, performance_config.api_max_in_flight),
+    "rule34": HostLimiter("rule34", performance_config.rule34_requests_per_second, performance_config.api_max_in_flight),
+}
@@ -0,0 +1,56 @@
+# app/services/http_client.py
+import logging
+from typing import Optional
+
+import aiohttp
+
+from app.config_reader import performance_config
+
+logger = logging.getLogger(__name__)
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=performance_config.http_connections_limit,
+        limit_per_host=performance_config.http_connections_per_host,
+        ttl_dns_cache=performance_config.http_dns_cache_ttl,
+        keepalive_timeout=performance_config.http_keepalive_timeout,
+        enable_cleanup_closed=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=HEADERS,
+        timeout=aiohttp.ClientTimeout(total=300, sock_connect=30),
+    )
+
+
+async def init_http_session() -> aiohttp.ClientSession:
+    """Создает общую для всего процесса HTTP-сессию (keep-alive, переиспользование TLS, кэш DNS)."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+        logger.info("Shared HTTP session created.")
+    return _session
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        # Normally created in main(); this covers code paths that run without it
+        _session = _create_session()
+        logger.warning("Shared HTTP session was not initialized, created lazily.")
+    return _session
+
+
+async def close_http_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("Shared HTTP session closed.")
+    _session = None
@@ -0,0 +1,95 @@
+# app/services/media_cache.py
+import asyncio
+import logging
+import os
+import re
+import uuid
+from pathlib import Path
+from typing import Dict, Optional
+
+from app.config_reader import performance_config
+
+logger = logging.getLogger(__name__)
+
+# Files still being written are hidden (dot-prefixed) until committed
+TMP_PREFIX = "."
+
+
+class MediaCache:
+    """
+    Кэш сконвертированных файлов на диске, ограниченный по суммарному размеру.
+    Файлы адресуются по md5 исходника (или по источнику и id поста), при переполнении
+    удаляются давно не использованные. Запись атомарна: файл сначала пишется во
+    временный, а затем переименовывается.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key_for(media_info: Dict) -> str:
+        if media_info.get('md5'):
+            key = str(media_info['md5'])
+        else:
+            key = f"{media_info.get('api_source', 'unknown')}_{media_info['id']}"
+        return re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+
+    def path_for(self, key: str, ext: str = "mp4") -> Path:
+        return self.directory / f"{key}.{ext}"
+
+    def get(self, key: str, ext: str = "mp4") -> Optional[Path]:
+        path = self.path_for(key, ext)
+        try:
+            # mtime serves as the LRU clock, atime is unreliable on noatime mounts
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        logger.info(f"Media cache hit for {path.name}.")
+        return path
+
+    def temp_path(self, key: str, ext: str = "mp4") -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # ffmpeg picks the muxer from the extension, so the temp name keeps it
+        return self.directory / f"{TMP_PREFIX}{key}.{uuid.uuid4().hex[:8]}.{ext}"
+
+    async def commit(self, key: str, temp_path: Path, ext: str = "mp4") -> Path:
+        path = self.path_for(key, ext)
+        os.replace(temp_path, path)
+        await asyncio.to_thread(self.evict)
+        return path
+
+    def evict(self):
+        entries = []
+        total = 0
+        for item in self.directory.iterdir():
+            if not item.is_file() or item.name.startswith(TMP_PREFIX):
+                continue
+            stat = item.stat()
+            entries.append((stat.st_mtime, stat.st_size, item))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        for _, size, item in sorted(entries):
+            try:
+                item.unlink()
+                total -= size
+                logger.info(f"Evicted {item.name} from media cache.")
+            except OSError as e:
+                logger.error(f"Failed to evict {item} from media cache: {e}")
+            if total <= self.max_bytes:
+                break
+
+    def remove_partial(self):
+        """Удаляет недописанные временные файлы, оставшиеся после падения."""
+        if not self.directory.exists():
+            return
+        for item in self.directory.iterdir():
+            if item.is_file() and item.name.startswith(TMP_PREFIX):
+                try:
+                    item.unlink()
+                except OSError as e:
+                    logger.error(f"Failed to remove partial cache file {item}: {e}")
+
+
+media_cache = MediaCache(Path("temp_media") / "cache", performance_config.media_cache_max_mb * 1024 * 1024)
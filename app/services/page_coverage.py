@@ -0,0 +1,97 @@
+# app/services/page_coverage.py
+import logging
+import random
+from typing import Hashable, Optional, Set
+
+from cachetools import TTLCache
+
+from app.config_reader import performance_config
+
+logger = logging.getLogger(__name__)
+
+
+class QueryExhaustedError(Exception):
+    """Все доступные страницы поискового запроса уже опубликованы."""
+
+
+class _Coverage:
+    def __init__(self, total: Optional[int]):
+        # Post count the page numbers refer to (None where the API doesn't report one)
+        self.total = total
+        self.exhausted: Set[int] = set()
+        # First page known to be empty
+        self.end: Optional[int] = None
+
+
+class PageCoverage:
+    """
+    Для каждого поискового запроса запоминает страницы, на которых все посты уже
+    опубликованы, чтобы не запрашивать их снова. Записи живут ttl секунд; при росте
+    количества постов номера страниц сдвигаются вслед за новыми постами, при уменьшении
+    запись сбрасывается.
+    """
+
+    def __init__(self, ttl: float, page_size: int = 100):
+        self.page_size = page_size
+        self._entries = TTLCache(maxsize=4096, ttl=ttl)
+
+    def _entry(self, key: Hashable, total: Optional[int] = None) -> _Coverage:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Coverage(total)
+        elif total is not None and entry.total is not None and total != entry.total:
+            entry = self._entries[key] = self._shifted(entry, total)
+        return entry
+
+    def _shifted(self, entry: _Coverage, total: int) -> _Coverage:
+        shifted = _Coverage(total)
+        added = total - entry.total
+        if added < 0:
+            # Deleted posts move later pages backwards by an unknown amount
+            return shifted
+        size = self.page_size
+        # New posts come first, so a new page is covered if every old page it overlaps was
+        candidates = {old + added // size + step for old in entry.exhausted for step in (0, 1)}
+        for page in candidates:
+            first_old, last_old = page * size - added, page * size + size - 1 - added
+            if first_old < 0:
+                continue
+            if all(old in entry.exhausted for old in range(first_old // size, last_old // size + 1)):
+                shifted.exhausted.add(page)
+        logger.debug(f"Page coverage shifted by {added} new posts, {len(shifted.exhausted)} pages still exhausted.")
+        return shifted
+
+    def mark_exhausted(self, key: Hashable, page: int, total: Optional[int] = None):
+        self._entry(key, total).exhausted.add(page)
+
+    def mark_end(self, key: Hashable, page: int):
+        entry = self._entry(key)
+        entry.end = page if entry.end is None else min(entry.end, page)
+
+    def choose_random(self, key: Hashable, total: int, max_pages: int) -> int:
+        """Случайная страница из еще не исчерпанных; QueryExhaustedError, если таких нет."""
+        pages = min(max_pages, (total - 1) // self.page_size + 1)
+        entry = self._entry(key, total)
+        if not entry.exhausted:
+            return random.randrange(pages)
+        open_pages = [page for page in range(pages) if page not in entry.exhausted]
+        if not open_pages:
+            raise QueryExhaustedError(f"all {pages} pages of {key} are already posted")
+        return random.choice(open_pages)
+
+    def first_open(self, key: Hashable, first_page: int, max_pages: int) -> Optional[int]:
+        """
+        Первая не исчерпанная страница для упорядоченной выдачи: None, если у запроса нет
+        результатов вовсе, QueryExhaustedError, если все страницы уже опубликованы.
+        """
+        entry = self._entry(key)
+        last = first_page + max_pages if entry.end is None else min(entry.end, first_page + max_pages)
+        if last <= first_page:
+            return None
+        page = next((p for p in range(first_page, last) if p not in entry.exhausted), None)
+        if page is None:
+            raise QueryExhaustedError(f"all pages of {key} before {last} are already posted")
+        return page
+
+
+page_coverage = PageCoverage(ttl=performance_config.page_coverage_ttl_hours * 3600)
@@ -0,0 +1,121 @@
+# app/services/sampler.py
+import math
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+# Weight halves for every this much age difference from the newest (or oldest) post in the pool
+RECENCY_HALF_LIFE_SECONDS = 7 * 24 * 3600
+# Without timestamps the id span of the pool stands in for time
+RECENCY_HALF_LIFE_ID_SPAN = 0.25
+
+_rng = np.random.default_rng()
+
+
+class CandidatePool:
+    """
+    Посты-кандидаты вместе с их id, рейтингом и временем создания в массивах NumPy,
+    чтобы веса и выборка считались векторно даже для десятков тысяч постов.
+    Удаленные посты помечаются в маске alive и вычищаются при накоплении.
+    """
+
+    def __init__(self, posts: Iterable[Dict[str, Any]] = ()):
+        self.posts: List[Dict[str, Any]] = []
+        self.ids = np.empty(0, dtype=np.int64)
+        self.scores = np.empty(0, dtype=np.float64)
+        self.created = np.empty(0, dtype=np.float64)
+        self.alive = np.empty(0, dtype=bool)
+        self.extend(posts)
+
+    def __len__(self) -> int:
+        return int(self.alive.sum())
+
+    def extend(self, posts: Iterable[Dict[str, Any]]):
+        posts = list(posts)
+        if not posts:
+            return
+        self.posts.extend(posts)
+        self.ids = np.concatenate([self.ids, np.fromiter((p['id'] for p in posts), dtype=np.int64, count=len(posts))])
+        self.scores = np.concatenate([self.scores, np.fromiter((p.get('score') or 0 for p in posts), dtype=np.float64, count=len(posts))])
+        self.created = np.concatenate([self.created, np.fromiter(
+            (math.nan if p.get('created_at') is None else p['created_at'] for p in posts), dtype=np.float64, count=len(posts)
+        )])
+        self.alive = np.concatenate([self.alive, np.ones(len(posts), dtype=bool)])
+
+    def alive_posts(self) -> List[Dict[str, Any]]:
+        return [self.posts[i] for i in np.flatnonzero(self.alive)]
+
+    def discard(self, mask: np.ndarray) -> int:
+        """Убирает посты, отмеченные в mask; возвращает, сколько живых постов было убрано."""
+        removed = int((self.alive & mask).sum())
+        self.alive &= ~mask
+        if removed and self.alive.size > 64 and self.alive.sum() * 2 < self.alive.size:
+            self._compact()
+        return removed
+
+    def trim(self, max_size: int) -> int:
+        """Оставляет не больше max_size живых постов, убирая добавленные раньше остальных."""
+        alive = np.flatnonzero(self.alive)
+        excess = alive.size - max_size
+        if excess <= 0:
+            return 0
+        self.alive[alive[:excess]] = False
+        self._compact()
+        return excess
+
+    def take(self, index: int) -> Dict[str, Any]:
+        self.alive[index] = False
+        return self.posts[index]
+
+    def _compact(self):
+        keep = np.flatnonzero(self.alive)
+        self.posts = [self.posts[i] for i in keep]
+        self.ids, self.scores, self.created = self.ids[keep], self.scores[keep], self.created[keep]
+        self.alive = np.ones(len(keep), dtype=bool)
+
+    def weights(self, priority: str) -> np.ndarray:
+        """Веса живых постов для приоритета канала; у удаленных постов вес 0."""
+        if priority in ('newest', 'oldest'):
+            weights = _recency_weights(self.ids, self.created, self.alive, newest=priority == 'newest')
+        elif priority == 'most_popular':
+            weights = np.maximum(self.scores, 0) + 1
+        elif priority == 'least_popular':
+            weights = 1 / (np.maximum(self.scores, 0) + 1)
+        else:
+            weights = np.ones(self.alive.size)
+        return np.where(self.alive, weights, 0.0)
+
+    def sample(self, priority: str, k: int = 1) -> np.ndarray:
+        """Индексы k разных постов, выбранных без возвращения пропорционально весам."""
+        return sample_without_replacement(self.weights(priority), k)
+
+
+def _recency_weights(ids: np.ndarray, created: np.ndarray, alive: np.ndarray, newest: bool) -> np.ndarray:
+    if not alive.any():
+        return np.zeros(alive.size)
+    if not np.isnan(created[alive]).any():
+        moments, half_life = created, RECENCY_HALF_LIFE_SECONDS
+    else:
+        moments = ids.astype(np.float64)
+        span = float(moments[alive].max() - moments[alive].min())
+        half_life = max(span * RECENCY_HALF_LIFE_ID_SPAN, 1.0)
+    # Ages are taken relative to the pool's own extreme, so the best post always weighs 1
+    age = (moments[alive].max() - moments) if newest else (moments - moments[alive].min())
+    return np.exp2(-np.maximum(age, 0) / half_life)
+
+
+def sample_without_replacement(weights: np.ndarray, k: int = 1, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """
+    Взвешенная выборка без возвращения (Efraimidis-Spirakis): у каждого элемента ключ
+    log(u) / w, выбираются k наибольших. Элементы с нулевым весом не выбираются никогда.
+    """
+    rng = rng or _rng
+    candidates = np.flatnonzero(weights > 0)
+    if candidates.size == 0:
+        return candidates
+    k = min(k, candidates.size)
+    keys = np.log(rng.random(candidates.size)) / weights[candidates]
+    if k == 1:
+        return candidates[[np.argmax(keys)]]
+    top = np.argpartition(keys, -k)[-k:]
+    return candidates[top[np.argsort(-keys[top])]]
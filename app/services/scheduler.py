@@ -3,22 +3,60 @@ import asyncio
 import logging
 import os
 import shutil
+import time
 import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Awaitable, Callable, Dict, Optional, Tuple
 
 import aiohttp
 import aiofiles
 from aiogram import Bot
-from aiogram.types import FSInputFile, URLInputFile
+from aiogram.types import FSInputFile, Message, URLInputFile
 from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramAPIError, TelegramEntityTooLarge, TelegramNetworkError
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from cachetools import TTLCache
 
-from app.services.api_client import get_api_client, HEADERS
-from app.database.db_manager import is_media_posted, add_posted_media, get_channel_settings, update_channel_setting
+from app.config_reader import performance_config
+from app.services.api_client import get_api_client, get_api_client_class
+from app.services.http_client import get_http_session
+from app.services.candidate_buffer import candidate_buffer, query_key
+from app.services.dispatcher import PostingDispatcher
+from app.services.media_cache import media_cache
+from app.services.page_coverage import QueryExhaustedError
+from app.utils import metrics, tracing
+from app.services.transcoder import transcoder, OutputTooLargeError, PRIORITY_SCHEDULED, PRIORITY_PREPARE, PRIORITY_ADMIN
+from app.database.db_manager import (
+    add_posted_media,
+    advance_newest_post_id,
+    is_media_posted,
+    get_posted_media_ids,
+    get_channel_settings,
+    update_channel_setting,
+    get_cached_file,
+    save_cached_file,
+    delete_cached_file
+)
 
 logger = logging.getLogger(__name__)
 TEMP_DIR = Path("temp_media")
+MAX_POSTING_ATTEMPTS = 15
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_PREPARE_CANDIDATES = 3
+# How many pages below the top a "newest" channel searches once it has caught up
+NEWEST_FALLBACK_PAGES = 5
+# Reference point for per-channel phase offsets of posting jobs
+PHASE_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# (admin_id, channel_id) -> {'post': ..., 'query': ...}: the post chosen for the next tick
+_prepared_posts: Dict[Tuple[int, int], Dict] = {}
+# (admin_id, channel_id) already told their query is exhausted; repeated once a day at most
+_exhausted_notified = TTLCache(maxsize=10_000, ttl=24 * 3600)
+
+
+class MediaTooLargeError(Exception):
+    """Файл превышает допустимый размер; скачивание прервано до его окончания."""
 
 
 async def cleanup_temp_media():
@@ -26,6 +64,10 @@ async def cleanup_temp_media():
         TEMP_DIR.mkdir(exist_ok=True)
         return
     for item in TEMP_DIR.iterdir():
+        if item == media_cache.directory:
+            # Converted media survive restarts, only unfinished writes are dropped
+            media_cache.remove_partial()
+            continue
         try:
             if item.is_file():
                 item.unlink()
@@ -45,6 +87,9 @@ async def check_dependencies():
     except FileNotFoundError:
         logger.critical("FFMPEG is not installed or not in PATH. Please install it (`sudo apt install ffmpeg`). WEBM conversion will fail.")
 
+    if not shutil.which("ffprobe"):
+        logger.warning("ffprobe is not installed or not in PATH. WEBM conversion will use a fixed profile instead of size-targeted one.")
+
     try:
         aria2c_check = await asyncio.create_subprocess_exec("aria2c", "--version", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
         await aria2c_check.communicate()
@@ -53,44 +98,76 @@ async def check_dependencies():
     except FileNotFoundError:
         logger.critical("aria2c is not installed or not in PATH. Please install it (`sudo apt install aria2`). Downloads will be slower.")
 
-async def add_posting_job(scheduler, bot: Bot, admin_id: int, channel_id: int, interval_minutes: int):
+def schedule_preparation(scheduler: PostingDispatcher, bot: Bot, admin_id: int, channel_id: int):
+    """Планирует подготовку следующего поста за prepare_lead_minutes до ближайшего запуска."""
+    job = scheduler.get_job(f"job_{admin_id}_{channel_id}")
+    if job is None or job.next_run_time is None:
+        return
+    run_date = max(job.next_run_time - timedelta(minutes=performance_config.prepare_lead_minutes), datetime.now(timezone.utc))
+    scheduler.add_date_job(f"prep_{admin_id}_{channel_id}", prepare_next_post, (bot, admin_id, channel_id), admin_id, run_date)
+
+def channel_phase_seconds(admin_id: int, channel_id: int, interval_minutes: int) -> int:
+    """Постоянный для канала сдвиг внутри интервала, чтобы каналы с одинаковым интервалом не срабатывали одновременно."""
+    interval_seconds = max(1, interval_minutes) * 60
+    return zlib.crc32(f"{admin_id}:{channel_id}".encode()) % interval_seconds
+
+async def add_posting_job(scheduler: PostingDispatcher, bot: Bot, admin_id: int, channel_id: int, interval_minutes: int):
     job_id = f"job_{admin_id}_{channel_id}"
-    if scheduler.get_job(job_id):
-        scheduler.reschedule_job(job_id, trigger="interval", minutes=interval_minutes)
+    rescheduled = scheduler.get_job(job_id) is not None
+    phase = channel_phase_seconds(admin_id, channel_id, interval_minutes)
+    # Anchoring in the past keeps the phase stable across restarts and reschedules
+    scheduler.add_interval_job(
+        job_id, posting_job, (bot, admin_id, channel_id, scheduler), admin_id,
+        interval=timedelta(minutes=interval_minutes), start_date=PHASE_EPOCH + timedelta(seconds=phase),
+        jitter=performance_config.posting_jitter_seconds,
+    )
+    if rescheduled:
         logger.info(f"Rescheduled job for admin {admin_id} and channel {channel_id} to every {interval_minutes} minutes.")
     else:
-        scheduler.add_job(
-            posting_job, "interval", minutes=interval_minutes,
-            args=[bot, admin_id, channel_id, scheduler], id=job_id
-        )
-        logger.info(f"Scheduled job for admin {admin_id} and channel {channel_id} every {interval_minutes} minutes.")
+        logger.info(f"Scheduled job for admin {admin_id} and channel {channel_id} every {interval_minutes} minutes (phase {phase}s).")
+    schedule_preparation(scheduler, bot, admin_id, channel_id)
 
-async def remove_posting_job(scheduler, admin_id: int, channel_id: int):
+async def remove_posting_job(scheduler: PostingDispatcher, admin_id: int, channel_id: int):
     job_id = f"job_{admin_id}_{channel_id}"
     if scheduler.get_job(job_id):
         scheduler.remove_job(job_id)
         logger.info(f"Removed job for admin {admin_id} and channel {channel_id}.")
+    scheduler.remove_job(f"prep_{admin_id}_{channel_id}")
+    _prepared_posts.pop((admin_id, channel_id), None)
 
-async def convert_webm_to_playable(original_path: Path, converted_path: Path) -> bool:
-    logger.info(f"Attempting to convert {original_path}...")
-    command = [
-        'ffmpeg', '-i', str(original_path),
-        '-c:v', 'libx264', '-c:a', 'aac', '-pix_fmt', 'yuv420p',
-        '-crf', '23', '-preset', 'ultrafast', # Changed to ultrafast for less CPU usage
-        '-y', '-loglevel', 'error', str(converted_path)
-    ]
-    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    _, stderr = await process.communicate()
-
-    if process.returncode != 0:
-        logger.error(f"FFMPEG failed for {original_path}. Stderr: {stderr.decode()}")
+@tracing.traced("transcode")
+async def convert_webm_to_playable(original_path: Path, converted_path: Path, priority: int = PRIORITY_SCHEDULED) -> bool:
+    logger.info(f"Queueing conversion of {original_path} (priority {priority})...")
+    try:
+        converted = await transcoder.submit(original_path, converted_path, TELEGRAM_UPLOAD_LIMIT, priority)
+    except OutputTooLargeError as e:
+        raise MediaTooLargeError(str(e)) from e
+    if not converted:
+        logger.error(f"FFMPEG failed for {original_path}.")
         return False
     logger.info(f"Successfully converted {original_path} to {converted_path}.")
     return True
 
-async def download_file(url: str, filepath: Path) -> bool:
-    user_agent = HEADERS.get("User-Agent", "Mozilla/5.0")
-    if shutil.which("aria2c"):
+async def get_remote_size(url: str) -> Optional[int]:
+    try:
+        async with get_http_session().head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=15)) as response:
+            if response.status == 200:
+                return response.content_length
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"HEAD request failed for {url}: {e}")
+    return None
+
+@tracing.traced("download")
+async def download_file(url: str, filepath: Path, max_bytes: int = TELEGRAM_UPLOAD_LIMIT) -> bool:
+    session = get_http_session()
+    remote_size = await get_remote_size(url)
+    if remote_size is not None and remote_size > max_bytes:
+        raise MediaTooLargeError(f"{url} is {remote_size} bytes, limit is {max_bytes} bytes")
+
+    user_agent = session.headers.get("User-Agent", "Mozilla/5.0")
+    started = time.monotonic()
+    # aria2c can't stop at max_bytes, so it is only used when the size is known to fit
+    if remote_size is not None and shutil.which("aria2c"):
         process = await asyncio.create_subprocess_exec(
             'aria2c', '--dir=' + str(filepath.parent), '--out=' + filepath.name,
             '--max-connection-per-server=16', '--split=16', '--min-split-size=1M',
@@ -100,24 +177,43 @@ async def download_file(url: str, filepath: Path) -> bool:
         )
         _, stderr = await process.communicate()
         if process.returncode == 0:
+            # The server may have lied in HEAD; the file is already fetched, but still must not be sent
+            if filepath.stat().st_size > max_bytes:
+                filepath.unlink(missing_ok=True)
+                raise MediaTooLargeError(f"{url} exceeds the limit of {max_bytes} bytes")
             logger.info(f"Successfully downloaded with aria2c to {filepath}.")
+            metrics.download_bytes_total.inc('aria2c', amount=filepath.stat().st_size)
+            metrics.download_seconds.observe(time.monotonic() - started, 'aria2c')
             return True
         logger.error(f"aria2c failed to download {url}. Stderr: {stderr.decode().strip()}")
     
-    logger.info(f"Falling back to aiohttp for {url}")
+    logger.info(f"Downloading {url} with aiohttp")
+    started = time.monotonic()
     try:
-        async with aiohttp.ClientSession(headers=HEADERS) as session:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                async with aiofiles.open(filepath, 'wb') as f:
-                    await f.write(await response.read())
-                logger.info(f"Successfully downloaded with aiohttp to {filepath}.")
-                return True
-    except aiohttp.ClientError as e:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            if response.content_length is not None and response.content_length > max_bytes:
+                raise MediaTooLargeError(f"{url} is {response.content_length} bytes, limit is {max_bytes} bytes")
+            downloaded = 0
+            async with aiofiles.open(filepath, 'wb') as f:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    downloaded += len(chunk)
+                    if downloaded > max_bytes:
+                        raise MediaTooLargeError(f"{url} exceeds the limit of {max_bytes} bytes")
+                    await f.write(chunk)
+            logger.info(f"Successfully downloaded {downloaded} bytes with aiohttp to {filepath}.")
+            metrics.download_bytes_total.inc('aiohttp', amount=downloaded)
+            metrics.download_seconds.observe(time.monotonic() - started, 'aiohttp')
+            return True
+    except MediaTooLargeError:
+        filepath.unlink(missing_ok=True)
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logger.error(f"aiohttp download failed for {url}: {e}")
+        filepath.unlink(missing_ok=True)
         return False
 
-async def send_media_by_url(bot: Bot, chat_id: int, media_info: Dict, kwargs: Dict) -> bool:
+async def send_media_by_url(bot: Bot, chat_id: int, media_info: Dict, kwargs: Dict) -> Optional[Message]:
     url, ext, post_id = media_info['url'], media_info['ext'], media_info['id']
     send_method = None
     
@@ -129,21 +225,28 @@ async def send_media_by_url(bot: Bot, chat_id: int, media_info: Dict, kwargs: Di
         send_method, kwargs['video'] = bot.send_video, URLInputFile(url, filename=f"{post_id}.{ext}")
     
     if send_method:
-        await send_method(chat_id=chat_id, **kwargs)
-        return True
-    return False
+        return await send_method(chat_id=chat_id, **kwargs)
+    return None
 
-async def send_media_by_file(bot: Bot, chat_id: int, admin_id: int, media_info: Dict, kwargs: Dict) -> bool:
+async def send_media_by_file(bot: Bot, chat_id: int, admin_id: int, media_info: Dict, kwargs: Dict, transcode_priority: int = PRIORITY_SCHEDULED) -> Optional[Message]:
     url, ext, source, post_id = media_info['url'], media_info['ext'], media_info['source'], media_info['id']
     random_suffix = uuid.uuid4().hex[:8]
     original_filepath = TEMP_DIR / f"{post_id}_{random_suffix}_orig.{ext}"
-    converted_filepath = TEMP_DIR / f"{post_id}_{random_suffix}_conv.mp4"
+    converted_filepath = None
     send_method = None
 
     try:
-        if not await download_file(url, original_filepath):
+        if ext == 'webm':
+            cache_key = media_cache.key_for(media_info)
+            cached_path = media_cache.get(cache_key)
+            if cached_path:
+                return await bot.send_video(chat_id=chat_id, video=FSInputFile(cached_path), **kwargs)
+
+        # WEBM is re-encoded before upload, so the source itself may exceed Telegram's limit
+        max_bytes = performance_config.max_webm_download_mb * 1024 * 1024 if ext == 'webm' else TELEGRAM_UPLOAD_LIMIT
+        if not await download_file(url, original_filepath, max_bytes=max_bytes):
             await bot.send_message(admin_id, f"❌ Не удалось скачать файл для поста {source}.")
-            return False
+            return None
 
         if ext in ['jpg', 'jpeg', 'png']:
             send_method, kwargs['photo'] = bot.send_photo, FSInputFile(original_filepath)
@@ -152,53 +255,127 @@ async def send_media_by_file(bot: Bot, chat_id: int, admin_id: int, media_info:
         elif ext == 'mp4':
             send_method, kwargs['video'] = bot.send_video, FSInputFile(original_filepath)
         elif ext == 'webm':
-            if not await convert_webm_to_playable(original_filepath, converted_filepath):
+            converted_filepath = media_cache.temp_path(cache_key)
+            if not await convert_webm_to_playable(original_filepath, converted_filepath, transcode_priority):
                 await bot.send_message(admin_id, f"⚠️ Не удалось конвертировать WEBM для поста {source}. Отправляю как документ.")
-                await bot.send_document(chat_id, document=FSInputFile(original_filepath), caption=kwargs.get('caption'), parse_mode='HTML')
-                return True
-            send_method, kwargs['video'] = bot.send_video, FSInputFile(converted_filepath)
+                return await bot.send_document(chat_id, document=FSInputFile(original_filepath), caption=kwargs.get('caption'), parse_mode='HTML')
+            cached_path = await media_cache.commit(cache_key, converted_filepath)
+            send_method, kwargs['video'] = bot.send_video, FSInputFile(cached_path)
         
         if send_method:
-            await send_method(chat_id=chat_id, **kwargs)
-            return True
-        return False
+            return await send_method(chat_id=chat_id, **kwargs)
+        return None
     finally:
         for p in [original_filepath, converted_filepath]:
-            if p.exists():
+            if p and p.exists():
                 try:
                     os.remove(p)
                 except OSError as e:
                     logger.error(f"Error removing temp file {p}: {e}")
 
-async def send_media(bot: Bot, chat_id: int, admin_id: int, media_info: Dict, scheduler: AsyncIOScheduler, custom_caption: Optional[str] = None, default_caption: Optional[str] = None) -> bool:
+def extract_file_id(message: Message) -> Optional[Tuple[str, str]]:
+    """Возвращает (file_id, тип медиа) из отправленного сообщения."""
+    if message.photo:
+        return message.photo[-1].file_id, 'photo'
+    # GIFs come back with both animation and document set, animation must win
+    if message.animation:
+        return message.animation.file_id, 'animation'
+    if message.video:
+        return message.video.file_id, 'video'
+    if message.document:
+        return message.document.file_id, 'document'
+    return None
+
+async def send_media_by_file_id(bot: Bot, chat_id: int, file_id: str, media_type: str, kwargs: Dict) -> Message:
+    send_method = {
+        'photo': bot.send_photo, 'animation': bot.send_animation,
+        'video': bot.send_video, 'document': bot.send_document
+    }[media_type]
+    return await send_method(chat_id, file_id, **kwargs)
+
+async def remember_file_id(media_info: Dict, message: Optional[Message]) -> Optional[Tuple[str, str]]:
+    file_ref = extract_file_id(message) if message else None
+    if file_ref and media_info.get('api_source'):
+        await save_cached_file(media_info['id'], media_info['api_source'], *file_ref)
+    return file_ref
+
+def is_file_id_error(error: TelegramBadRequest) -> bool:
+    """Telegram отверг сам file_id (удален, от другого бота или поврежден), а не остальной запрос."""
+    message = str(error).lower()
+    return "file identifier" in message or "file_id" in message or "file reference" in message
+
+async def send_admin_copy(bot: Bot, admin_id: int, chat_id: int, media_info: Dict, file_ref: Optional[Tuple[str, str]],
+                          admin_kwargs: Dict, resend: Optional[Callable[[], Awaitable]] = None):
+    """
+    Отправляет администратору копию поста, уже опубликованного в канале. Ошибки здесь
+    только логируются: пост не должен уйти в канал повторно из-за неудачной копии.
+    """
+    try:
+        if file_ref:
+            await send_media_by_file_id(bot, admin_id, *file_ref, admin_kwargs.copy())
+        elif resend:
+            await resend()
+    except Exception as e:
+        logger.warning(f"Post {media_info['id']} was sent to channel {chat_id}, but the copy for admin {admin_id} failed: {e}")
+        try:
+            await bot.send_message(admin_id, f"✅ Пост {media_info['source']} отправлен в канал {chat_id}, но копию для вас отправить не удалось: {e}")
+        except TelegramAPIError as notify_error:
+            logger.error(f"Failed to notify admin {admin_id} about the failed copy: {notify_error}")
+
+@tracing.traced("send_media")
+async def send_media(bot: Bot, chat_id: int, admin_id: int, media_info: Dict, scheduler: PostingDispatcher, custom_caption: Optional[str] = None, default_caption: Optional[str] = None) -> bool:
     source = media_info['source']
     caption = custom_caption or default_caption or f'<a href="{source}">Источник</a>'
     caption = caption.replace("{{source}}", f'<a href="{source}">Источник</a>').replace("{{tags}}", ", ".join(media_info.get('tags', [])))
     send_kwargs = {'caption': caption, 'parse_mode': 'HTML', 'request_timeout': 300}
 
+    admin_kwargs = {**send_kwargs, 'caption': f"✅ Отправлено в канал {chat_id}.\n{caption}"}
+    api_source = media_info.get('api_source')
+
     try:
+        # A post uploaded before can be re-sent by its Telegram file_id without downloading it again
+        cached_file = await get_cached_file(media_info['id'], api_source) if api_source else None
+        if cached_file:
+            logger.info(f"Sending post {media_info['id']} by cached file_id.")
+            try:
+                await send_media_by_file_id(bot, chat_id, cached_file['file_id'], cached_file['media_type'], send_kwargs.copy())
+            except TelegramBadRequest as e:
+                # Other bad requests (e.g. a too long caption) would fail from the source just the same
+                if not is_file_id_error(e):
+                    raise
+                logger.warning(f"Cached file_id for post {media_info['id']} was rejected: {e}. Sending from source.")
+                await delete_cached_file(media_info['id'], api_source)
+            else:
+                await send_admin_copy(bot, admin_id, chat_id, media_info, (cached_file['file_id'], cached_file['media_type']), admin_kwargs)
+                return True
+
         # First, try sending by URL
         if media_info['ext'] not in ['webm']:
             logger.info(f"Attempting to send post {media_info['id']} by URL.")
             try:
-                if await send_media_by_url(bot, chat_id, media_info, send_kwargs.copy()):
-                    # Send notification to admin
-                    admin_kwargs = {**send_kwargs.copy(), 'caption': f"✅ Отправлено в канал {chat_id}.\n{caption}"}
-                    await send_media_by_url(bot, admin_id, media_info, admin_kwargs)
-                    return True
+                message = await send_media_by_url(bot, chat_id, media_info, send_kwargs.copy())
             except (TelegramNetworkError, TelegramBadRequest, TelegramAPIError) as e:
                 if isinstance(e, TelegramNetworkError) or "wrong file identifier/http url specified" in str(e) or "failed to get HTTP URL content" in str(e):
                     logger.warning(f"Failed to send post {media_info['id']} by URL: {e}. Falling back to file download.")
                     await bot.send_message(admin_id, f"⚠️ Не удалось отправить пост {source} по URL. Пробую скачать и отправить вручную.")
                 else:
                     raise # Re-raise other Telegram API errors
+            else:
+                if message:
+                    # Send notification to admin
+                    file_ref = await remember_file_id(media_info, message)
+                    await send_admin_copy(bot, admin_id, chat_id, media_info, file_ref, admin_kwargs,
+                                          resend=lambda: send_media_by_url(bot, admin_id, media_info, admin_kwargs.copy()))
+                    return True
 
         # Fallback to sending by file if URL fails or for webm
         logger.info(f"Sending post {media_info['id']} by file download.")
-        if await send_media_by_file(bot, chat_id, admin_id, media_info, send_kwargs.copy()):
+        message = await send_media_by_file(bot, chat_id, admin_id, media_info, send_kwargs.copy())
+        if message:
             # Send notification to admin
-            admin_kwargs = {**send_kwargs.copy(), 'caption': f"✅ Отправлено в канал {chat_id}.\n{caption}"}
-            await send_media_by_file(bot, admin_id, admin_id, media_info, admin_kwargs)
+            file_ref = await remember_file_id(media_info, message)
+            await send_admin_copy(bot, admin_id, chat_id, media_info, file_ref, admin_kwargs,
+                                  resend=lambda: send_media_by_file(bot, admin_id, admin_id, media_info, admin_kwargs.copy(), transcode_priority=PRIORITY_ADMIN))
             return True
         return False
 
@@ -208,7 +385,7 @@ async def send_media(bot: Bot, chat_id: int, admin_id: int, media_info: Dict, sc
         await remove_posting_job(scheduler, admin_id, chat_id)
         await bot.send_message(admin_id, f"❌ Ошибка: Бот не является администратором в канале {chat_id} или был кикнут. Автопостинг для этого канала остановлен.")
         return False
-    except TelegramEntityTooLarge:
+    except (TelegramEntityTooLarge, MediaTooLargeError):
         logger.warning(f"Media file for post {source} is too large for Telegram. Skipping.")
         await bot.send_message(admin_id, f"❌ Файл для поста {source} слишком большой для Telegram. Пропускаю.")
         return True # Mark as posted to avoid retrying
@@ -217,48 +394,178 @@ async def send_media(bot: Bot, chat_id: int, admin_id: int, media_info: Dict, sc
         await bot.send_message(admin_id, f"❌ Непредвиденная ошибка при обработке поста {source}: {e}")
         return False
 
-async def posting_job(bot: Bot, admin_id: int, channel_id: int, scheduler: AsyncIOScheduler, custom_caption: Optional[str] = None):
+def make_posts_fetcher(channel_settings: Dict):
+    api_source = channel_settings['api_source']
+    search = dict(
+        tags=channel_settings['tags'],
+        negative_tags=channel_settings['negative_tags'],
+        tags_mode=channel_settings.get('tags_mode', 'AND'),
+        post_priority=channel_settings.get('post_priority', 'random')
+    )
+
+    async def fetch_posts():
+        return await get_api_client(api_source).get_posts(**search)
+
+    async def fetch_newest_posts():
+        client = get_api_client(api_source)
+        newest_post_id = channel_settings.get('newest_post_id')
+        if newest_post_id:
+            posts = await client.get_posts(**search, after_id=newest_post_id)
+            # Posts above the watermark may already be posted by another channel with the same source
+            if posts and len(await get_posted_media_ids([post['id'] for post in posts], api_source)) < len(posts):
+                return posts
+        # Nothing unposted newer than the watermark: walk down from the top to the first page with unposted posts
+        before_id = None
+        for _ in range(NEWEST_FALLBACK_PAGES):
+            posts = await client.get_posts(**search, before_id=before_id)
+            if not posts:
+                return []
+            posted_ids = await get_posted_media_ids([post['id'] for post in posts], api_source)
+            if len(posted_ids) < len(posts):
+                return posts
+            before_id = min(post['id'] for post in posts)
+        return []
+
+    return fetch_newest_posts if search['post_priority'] == 'newest' else fetch_posts
+
+async def prepare_media(media_info: Dict) -> bool:
+    """Заранее скачивает и конвертирует WEBM в кэш, чтобы в момент постинга осталась только отправка."""
+    if media_info['ext'] != 'webm':
+        # Other formats are sent by URL, Telegram fetches them itself
+        return True
+    if media_info.get('api_source') and await get_cached_file(media_info['id'], media_info['api_source']):
+        return True
+    cache_key = media_cache.key_for(media_info)
+    if media_cache.get(cache_key):
+        return True
+
+    original_filepath = TEMP_DIR / f"{media_info['id']}_{uuid.uuid4().hex[:8]}_prep.webm"
+    converted_filepath = None
+    try:
+        if not await download_file(media_info['url'], original_filepath, max_bytes=performance_config.max_webm_download_mb * 1024 * 1024):
+            return False
+        converted_filepath = media_cache.temp_path(cache_key)
+        if not await convert_webm_to_playable(original_filepath, converted_filepath, PRIORITY_PREPARE):
+            return False
+        await media_cache.commit(cache_key, converted_filepath)
+        return True
+    finally:
+        for p in [original_filepath, converted_filepath]:
+            if p and p.exists():
+                try:
+                    os.remove(p)
+                except OSError as e:
+                    logger.error(f"Error removing temp file {p}: {e}")
+
+async def prepare_next_post(bot: Bot, admin_id: int, channel_id: int):
+    with tracing.tracer.trace("prepare_next_post", admin_id=admin_id, channel_id=channel_id):
+        await _prepare_next_post(admin_id, channel_id)
+
+async def _prepare_next_post(admin_id: int, channel_id: int):
+    channel_settings = await get_channel_settings(admin_id, channel_id)
+    if not channel_settings or not channel_settings.get('is_active'):
+        return
+    key = query_key(channel_settings)
+    prepared = _prepared_posts.get((admin_id, channel_id))
+    if prepared and prepared['query'] == key and not await is_media_posted(prepared['post']['id'], key[0]):
+        return
+
+    api_source = channel_settings['api_source']
+    post_priority = channel_settings.get('post_priority', 'random')
+    api_client_class = get_api_client_class(api_source)
+    logger.info(f"Preparing next post for admin {admin_id} and channel {channel_id}")
+    try:
+        for _ in range(MAX_PREPARE_CANDIDATES):
+            with tracing.span("get_post"):
+                post = await candidate_buffer.pop(
+                    key, make_posts_fetcher(channel_settings), api_client_class.sampling_priority(post_priority)
+                )
+            if not post:
+                return
+            tracing.annotate(post_id=post['id'])
+            try:
+                if await prepare_media(post):
+                    _prepared_posts[(admin_id, channel_id)] = {'post': post, 'query': key}
+                    logger.info(f"Prepared post {post['id']} for admin {admin_id} and channel {channel_id}.")
+                    return
+            except MediaTooLargeError as e:
+                logger.warning(f"Skipping post {post['id']} while preparing: {e}")
+    except QueryExhaustedError as e:
+        logger.info(f"Nothing to prepare for admin {admin_id} and channel {channel_id}: {e}")
+    except Exception as e:
+        logger.exception(f"Failed to prepare next post for admin {admin_id} and channel {channel_id}: {e}")
+
+async def posting_job(bot: Bot, admin_id: int, channel_id: int, scheduler: PostingDispatcher, custom_caption: Optional[str] = None, manual: bool = False):
+    """
+    Публикует один пост в канал. manual=True для запусков по команде администратора: они не
+    забирают пост, подготовленный к следующему запуску по расписанию, и не готовят новый.
+    """
+    with tracing.tracer.trace("posting_job", admin_id=admin_id, channel_id=channel_id):
+        await _posting_job(bot, admin_id, channel_id, scheduler, custom_caption, manual)
+
+async def _posting_job(bot: Bot, admin_id: int, channel_id: int, scheduler: PostingDispatcher, custom_caption: Optional[str], manual: bool):
     logger.info(f"Starting posting job for admin {admin_id} and channel {channel_id}")
     channel_settings = await get_channel_settings(admin_id, channel_id)
     if not channel_settings or (not custom_caption and (not channel_settings.get('is_active') or not channel_settings.get('channel_id'))):
         logger.warning(f"Posting job for admin {admin_id} and channel {channel_id} skipped due to inactive status or missing settings.")
+        tracing.annotate(result='skipped')
         return
 
     default_caption = channel_settings.get('default_caption')
 
+    api_source = channel_settings['api_source']
+    post_priority = channel_settings.get('post_priority', 'random')
+    fetch_posts = make_posts_fetcher(channel_settings)
+    started = time.monotonic()
+    result = 'no_content'
+
     try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300)) as session:
-            api_client = get_api_client(channel_settings['api_source'], session)
-            
-            for attempt in range(15):
-                logger.info(f"Attempt {attempt + 1}/15 to find new content for admin {admin_id} and channel {channel_id}")
-                post = await api_client.get_post(
-                    tags=channel_settings['tags'],
-                    negative_tags=channel_settings['negative_tags'],
-                    tags_mode=channel_settings.get('tags_mode', 'AND'),
-                    post_priority=channel_settings.get('post_priority', 'random')
-                )
+        api_client_class = get_api_client_class(api_source)
+        key = query_key(channel_settings)
+        # Manual posts don't consume the post prepared for the next scheduled tick
+        prepared = None if manual else _prepared_posts.pop((admin_id, channel_id), None)
 
-                if not post:
-                    await asyncio.sleep(2)
-                    continue
-
-                if not await is_media_posted(post['id'], channel_settings['api_source']):
-                    logger.info(f"Found new post {post['id']} for admin {admin_id} and channel {channel_id}")
-                    if await send_media(bot, channel_id, admin_id, post, scheduler, custom_caption=custom_caption, default_caption=default_caption):
-                        await add_posted_media(post['id'], channel_settings['api_source'])
-                        logger.info(f"Successfully posted media {post['id']} for admin {admin_id} and channel {channel_id}.")
-                        return
-                    else:
-                        logger.warning(f"Failed to send media for post {post['id']}. Trying next post.")
+        for attempt in range(MAX_POSTING_ATTEMPTS):
+            logger.info(f"Attempt {attempt + 1}/{MAX_POSTING_ATTEMPTS} to find new content for admin {admin_id} and channel {channel_id}")
+            with tracing.span("get_post"):
+                if prepared and prepared['query'] == key and not await is_media_posted(prepared['post']['id'], api_source):
+                    post = prepared['post']
+                    logger.info(f"Using post {post['id']} prepared ahead of time.")
                 else:
-                    logger.info(f"Post {post['id']} has already been posted. Skipping.")
-                
-                await asyncio.sleep(1)
+                    post = await candidate_buffer.pop(key, fetch_posts, api_client_class.sampling_priority(post_priority))
+            prepared = None
+            if not post:
+                await asyncio.sleep(2)
+                continue
+            tracing.annotate(post_id=post['id'])
 
-        logger.warning(f"Failed to find new content for admin_id={admin_id} and channel_id={channel_id} after 15 attempts.")
-        await bot.send_message(admin_id, f"⚠️ Не удалось найти новый контент для постинга в канал {channel_id} после 15 попыток.")
+            logger.info(f"Found new post {post['id']} for admin {admin_id} and channel {channel_id}")
+            if await send_media(bot, channel_id, admin_id, post, scheduler, custom_caption=custom_caption, default_caption=default_caption):
+                await add_posted_media(post['id'], api_source)
+                if post_priority == 'newest':
+                    await advance_newest_post_id(admin_id, channel_id, post['id'])
+                logger.info(f"Successfully posted media {post['id']} for admin {admin_id} and channel {channel_id}.")
+                result = 'posted'
+                metrics.posting_attempts.observe(attempt + 1)
+                return
+            logger.warning(f"Failed to send media for post {post['id']}. Trying next post.")
+            await asyncio.sleep(1)
 
+        logger.warning(f"Failed to find new content for admin_id={admin_id} and channel_id={channel_id} after {MAX_POSTING_ATTEMPTS} attempts.")
+        await bot.send_message(admin_id, f"⚠️ Не удалось найти новый контент для постинга в канал {channel_id} после {MAX_POSTING_ATTEMPTS} попыток.")
+
+    except QueryExhaustedError as e:
+        result = 'exhausted'
+        logger.warning(f"Query of admin {admin_id} and channel {channel_id} is exhausted: {e}")
+        if (admin_id, channel_id) not in _exhausted_notified:
+            _exhausted_notified[(admin_id, channel_id)] = None
+            await bot.send_message(admin_id, f"🔚 Все посты по запросу канала {channel_id} уже опубликованы. Измените теги или дождитесь новых постов.")
     except Exception as e:
+        result = 'error'
         logger.exception(f"A critical error occurred in the posting job for admin {admin_id} and channel {channel_id}: {e}")
         await bot.send_message(admin_id, f"❌ Произошла критическая ошибка в задаче постинга для канала {channel_id}: {e}")
+    finally:
+        metrics.posting_job_seconds.observe(time.monotonic() - started, result)
+        tracing.annotate(result=result)
+        if not manual:
+            schedule_preparation(scheduler, bot, admin_id, channel_id)
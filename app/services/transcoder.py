@@ -0,0 +1,269 @@
+# app/services/transcoder.py
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from app.config_reader import performance_config
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lower value = served first
+PRIORITY_SCHEDULED = 0
+PRIORITY_PREPARE = 5
+PRIORITY_ADMIN = 10
+
+
+# Codecs that can go into an MP4 for Telegram without re-encoding
+COPYABLE_VIDEO_CODECS = {'h264'}
+COPYABLE_AUDIO_CODECS = {'aac', 'mp3'}
+AUDIO_BITRATE = 128_000
+MIN_VIDEO_BITRATE = 150_000
+MAX_VIDEO_BITRATE = 8_000_000
+# Leaves room for MP4 container overhead and rate-control overshoot
+SIZE_BUDGET_HEADROOM = 0.9
+# Bits per pixel per frame below which the source resolution is stepped down
+MIN_BITS_PER_PIXEL = 0.06
+HEIGHT_LADDER = (1080, 720, 540, 480, 360, 240)
+
+
+class OutputTooLargeError(Exception):
+    """Видео не уместится в заданный размер даже при минимальном битрейте."""
+
+
+def default_max_parallel() -> int:
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+async def _kill_if_running(process: asyncio.subprocess.Process):
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+async def run_ffmpeg(command: List[str], timeout: float) -> bool:
+    """
+    Запускает ffmpeg и убивает процесс, если он не уложился в timeout секунд или
+    вызывающая задача была отменена (например, при остановке бота).
+    """
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    finally:
+        await _kill_if_running(process)
+    if process.returncode != 0:
+        logger.error(f"FFMPEG exited with code {process.returncode}. Stderr: {stderr.decode()}")
+        return False
+    return True
+
+
+async def probe_media(path: Path, timeout: float = 30) -> Optional[Dict[str, Any]]:
+    command = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', str(path)]
+    try:
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        logger.warning("ffprobe is not installed, using the default transcoding profile.")
+        return None
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"ffprobe timed out for {path}.")
+        return None
+    finally:
+        await _kill_if_running(process)
+    if process.returncode != 0:
+        logger.error(f"ffprobe failed for {path}. Stderr: {stderr.decode()}")
+        return None
+    try:
+        return json.loads(stdout)
+    except ValueError as e:
+        logger.error(f"Could not parse ffprobe output for {path}: {e}")
+        return None
+
+
+def _parse_frame_rate(rate: Optional[str]) -> float:
+    try:
+        num, _, den = (rate or "").partition('/')
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def choose_profile(probe: Optional[Dict[str, Any]], size_budget: int) -> List[str]:
+    """
+    Подбирает параметры ffmpeg по данным ffprobe: перепаковка без перекодирования, если
+    кодеки уже подходят, иначе битрейт и разрешение рассчитываются так, чтобы файл
+    уложился в size_budget байт.
+    """
+    default_profile = ['-c:v', 'libx264', '-c:a', 'aac', '-pix_fmt', 'yuv420p', '-crf', '23', '-preset', 'ultrafast']
+    if not probe:
+        return default_profile
+
+    streams = probe.get('streams', [])
+    video = next((st for st in streams if st.get('codec_type') == 'video'), None)
+    audio = next((st for st in streams if st.get('codec_type') == 'audio'), None)
+    if video is None:
+        return default_profile
+    fmt = probe.get('format', {})
+    source_size = int(fmt.get('size') or 0)
+    audio_copyable = audio is None or audio.get('codec_name') in COPYABLE_AUDIO_CODECS
+
+    # Only the container is wrong: remux without touching the streams
+    if (video.get('codec_name') in COPYABLE_VIDEO_CODECS and video.get('pix_fmt') == 'yuv420p'
+            and audio_copyable and 0 < source_size <= size_budget):
+        return ['-c', 'copy', '-movflags', '+faststart']
+
+    if audio is None:
+        audio_args, audio_bitrate = ['-an'], 0
+    elif audio_copyable:
+        audio_args, audio_bitrate = ['-c:a', 'copy'], int(audio.get('bit_rate') or AUDIO_BITRATE)
+    else:
+        audio_args, audio_bitrate = ['-c:a', 'aac', '-b:a', str(AUDIO_BITRATE)], AUDIO_BITRATE
+
+    duration = float(fmt.get('duration') or video.get('duration') or 0)
+    if duration <= 0:
+        return ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '23', '-preset', 'ultrafast', *audio_args, '-movflags', '+faststart']
+
+    video_bitrate = int(size_budget * 8 * SIZE_BUDGET_HEADROOM / duration) - audio_bitrate
+    if video_bitrate < MIN_VIDEO_BITRATE:
+        raise OutputTooLargeError(f"{duration:.0f}s of video can't fit into {size_budget} bytes")
+    video_bitrate = min(video_bitrate, MAX_VIDEO_BITRATE)
+
+    video_args = ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-preset', 'ultrafast',
+                  # CRF keeps small files small, the maxrate cap keeps big ones within budget
+                  '-crf', '23', '-maxrate', str(video_bitrate), '-bufsize', str(video_bitrate * 2)]
+
+    width, height = int(video.get('width') or 0), int(video.get('height') or 0)
+    fps = _parse_frame_rate(video.get('avg_frame_rate')) or 30.0
+    if width and height and video_bitrate / (width * height * fps) < MIN_BITS_PER_PIXEL:
+        target_height = next(
+            (h for h in HEIGHT_LADDER if h < height and video_bitrate / (h * h * width / height * fps) >= MIN_BITS_PER_PIXEL),
+            HEIGHT_LADDER[-1]
+        )
+        if target_height < height:
+            video_args += ['-vf', f'scale=-2:{target_height}']
+
+    return [*video_args, *audio_args, '-movflags', '+faststart']
+
+
+class _TranscodeJob:
+    def __init__(self, original_path: Path, converted_path: Path, size_budget: int):
+        self.original_path = original_path
+        self.converted_path = converted_path
+        self.size_budget = size_budget
+        self.queued_at = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class TranscodeService:
+    """Очередь конвертаций с приоритетами и ограниченным числом одновременных ffmpeg."""
+
+    def __init__(self, max_parallel: int, timeout: float):
+        self.max_parallel = max_parallel
+        self.timeout = timeout
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: List[asyncio.Task] = []
+        self._counter = itertools.count()
+        self._running = 0
+        self._stats = {
+            "completed": 0, "failed": 0, "timeouts": 0,
+            "wait_seconds_total": 0.0, "run_seconds_total": 0.0, "max_queue_depth": 0,
+        }
+
+    def start(self):
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.max_parallel)]
+        logger.info(f"Transcoding service started with {self.max_parallel} workers, timeout {self.timeout}s.")
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, job = self._queue.get_nowait()
+                if not job.future.done():
+                    job.future.cancel()
+        logger.info("Transcoding service stopped.")
+
+    async def submit(self, original_path: Path, converted_path: Path, size_budget: int, priority: int = PRIORITY_SCHEDULED) -> bool:
+        """Ставит конвертацию в очередь; OutputTooLargeError, если результат не уместится в size_budget."""
+        self.start()
+        job = _TranscodeJob(original_path, converted_path, size_budget)
+        self._queue.put_nowait((priority, next(self._counter), job))
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queue.qsize())
+        return await job.future
+
+    async def _worker(self, worker_id: int):
+        while True:
+            _, _, job = await self._queue.get()
+            if job.future.done():
+                continue
+            wait = time.monotonic() - job.queued_at
+            self._stats["wait_seconds_total"] += wait
+            metrics.transcode_queue_seconds.observe(wait)
+            self._running += 1
+            started = time.monotonic()
+            try:
+                result = await self._convert(job)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except OutputTooLargeError as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+                result = False
+            except Exception as e:
+                logger.exception(f"Transcoding worker {worker_id} failed on {job.original_path}: {e}")
+                result = False
+            finally:
+                self._running -= 1
+                self._stats["run_seconds_total"] += time.monotonic() - started
+            self._stats["completed" if result else "failed"] += 1
+            metrics.transcode_seconds.observe(time.monotonic() - started, "ok" if result else "failed")
+            if not job.future.done():
+                job.future.set_result(result)
+            logger.info(f"Transcode of {job.original_path} {'succeeded' if result else 'failed'} after {wait:.1f}s in queue and {time.monotonic() - started:.1f}s of work.")
+
+    async def _convert(self, job: _TranscodeJob) -> bool:
+        profile = choose_profile(await probe_media(job.original_path), job.size_budget)
+        logger.info(f"Transcoding {job.original_path} with profile: {' '.join(profile)}")
+        command = ['ffmpeg', '-i', str(job.original_path), *profile, '-y', '-loglevel', 'error', str(job.converted_path)]
+        try:
+            return await run_ffmpeg(command, self.timeout)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            logger.error(f"FFMPEG timed out after {self.timeout}s for {job.original_path}, process killed.")
+            return False
+
+    def stats(self) -> Dict[str, float]:
+        done = self._stats["completed"] + self._stats["failed"]
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "running": self._running,
+            "max_parallel": self.max_parallel,
+            "completed": self._stats["completed"],
+            "failed": self._stats["failed"],
+            "timeouts": self._stats["timeouts"],
+            "max_queue_depth": self._stats["max_queue_depth"],
+            "avg_wait_seconds": self._stats["wait_seconds_total"] / done if done else 0.0,
+            "avg_run_seconds": self._stats["run_seconds_total"] / done if done else 0.0,
+        }
+
+
+transcoder = TranscodeService(
+    max_parallel=performance_config.transcode_max_parallel or default_max_parallel(),
+    timeout=performance_config.transcode_timeout_seconds,
+)
@@ -12,5 +12,6 @@ async def set_commands(bot: Bot):
         BotCommand(command="backup", description="💾 Резервное копирование настроек"),
         BotCommand(command="restore", description="🔄 Восстановление настроек"),
         BotCommand(command="health_check", description="🩺 Проверка состояния бота"),
+        BotCommand(command="slow_posts", description="🐢 Самые медленные публикации"),
     ]
     await bot.set_my_commands(commands, BotCommandScopeDefault())
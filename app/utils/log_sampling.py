@@ -0,0 +1,40 @@
+# app/utils/log_sampling.py
+import logging
+import time
+from typing import Dict, Tuple
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает не больше burst записей из одной строки кода за window секунд; остальные
+    отбрасываются, а их количество дописывается к первой записи следующего окна.
+    Предупреждения и ошибки не ограничиваются.
+    """
+
+    def __init__(self, burst: int, window: float = 60, max_level: int = logging.INFO):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.max_level = max_level
+        # (logger, file, line) -> [window start, emitted in window, suppressed in window]
+        self._windows: Dict[Tuple[str, str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level:
+            return True
+        # Messages are f-strings, so the call site is what identifies "the same" message
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        state = self._windows.get(key)
+        if state is None or now - state[0] >= self.window:
+            suppressed = state[2] if state else 0
+            self._windows[key] = [now, 1, 0]
+            if suppressed:
+                record.msg = f"{record.getMessage()} ({suppressed} similar messages suppressed)"
+                record.args = None
+            return True
+        if state[1] < self.burst:
+            state[1] += 1
+            return True
+        state[2] += 1
+        return False
@@ -0,0 +1,137 @@
+# app/utils/metrics.py
+import bisect
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 10, 15)
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Tuple) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными границами: на каждое наблюдение - только инкременты счетчиков."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._values: Dict[Tuple, List] = {}
+
+    def observe(self, value: float, *labels):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                bucket_labels = _format_labels((*self.labelnames, "le"), (*labels, bound))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Pipeline metrics ---
+
+posting_job_seconds = Histogram("posting_job_seconds", "Duration of posting_job runs.", ["result"])
+posting_attempts = Histogram("posting_attempts", "Attempts needed for a successful post.", buckets=COUNT_BUCKETS)
+api_request_seconds = Histogram("api_request_seconds", "Booru API request latency, excluding rate limiter wait.", ["host"])
+api_wait_seconds = Histogram("api_rate_limit_wait_seconds", "Time spent waiting for the per-host rate limiter.", ["host"])
+api_requests_total = Counter("api_requests_total", "Booru API responses by status.", ["host", "status"])
+download_bytes_total = Counter("download_bytes_total", "Bytes of media downloaded.", ["method"])
+download_seconds = Histogram("download_seconds", "Media download duration.", ["method"])
+transcode_queue_seconds = Histogram("transcode_queue_seconds", "Time a conversion waited for a free ffmpeg slot.")
+transcode_seconds = Histogram("transcode_seconds", "ffmpeg conversion duration.", ["result"])
+telegram_request_seconds = Histogram("telegram_request_seconds", "Bot API request latency.", ["method"])
+telegram_errors_total = Counter("telegram_errors_total", "Bot API errors by type.", ["method", "error"])
+db_seconds = Histogram("db_seconds", "Time a database connection was held per operation.", ["mode"], buckets=DB_BUCKETS)
+scheduler_lag_seconds = Histogram("scheduler_lag_seconds", "Delay between a job's due time and its start.")
+
+
+# --- HTTP endpoint ---
+
+_runner: Optional[web.AppRunner] = None
+
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_metrics_server(host: str, port: int):
+    """Поднимает /metrics в формате Prometheus на host:port."""
+    global _runner
+    if _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    _runner = runner
+    logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,40 @@
+# app/utils/token_bucket.py
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Ведро токенов с резервированием: каждый вызов acquire() занимает следующий
+    свободный слот, поэтому конкурирующие корутины обслуживаются по очереди без блокировок.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self) -> float:
+        """Занимает токен и возвращает, сколько секунд нужно подождать до его наступления."""
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    async def acquire(self) -> float:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def pause(self, seconds: float):
+        """Не выдает токены ближайшие seconds секунд (например, после retry_after от сервера)."""
+        now = time.monotonic()
+        self._refill(now)
+        # The first token after the pause becomes available exactly `seconds` from now
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
@@ -0,0 +1,111 @@
+# app/utils/tracing.py
+import functools
+import heapq
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.config_reader import performance_config
+
+# A runaway retry loop shouldn't grow a single trace without bound
+MAX_SPANS_PER_TRACE = 200
+
+# (trace, path of the innermost open span) of the job running in the current task
+_current: ContextVar[Optional[Tuple["Trace", Tuple[str, ...]]]] = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Один запуск задачи: его атрибуты (канал, пост, результат) и время каждого этапа."""
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.duration: Optional[float] = None
+        # (path, seconds) in the order the spans finished
+        self.spans: List[Tuple[Tuple[str, ...], float]] = []
+
+    def add_span(self, path: Tuple[str, ...], seconds: float):
+        # Spans of background tasks can outlive the job that spawned them
+        if self.duration is None and len(self.spans) < MAX_SPANS_PER_TRACE:
+            self.spans.append((path, seconds))
+
+    def breakdown(self) -> List[Tuple[Tuple[str, ...], int, float]]:
+        """Этапы, сгруппированные по пути вложенности: (путь, число вызовов, суммарное время)."""
+        totals: Dict[Tuple[str, ...], List] = {}
+        for path, seconds in self.spans:
+            entry = totals.setdefault(path, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        # Parents finish after their children: sort by the ancestors' order so each parent precedes its stages
+        order = {path: index for index, path in enumerate(totals)}
+        ordered = sorted(totals, key=lambda path: tuple(order.get(path[:depth + 1], len(order)) for depth in range(len(path))))
+        return [(path, totals[path][0], totals[path][1]) for path in ordered]
+
+
+class Tracer:
+    """
+    Хранит последние capacity завершенных задач в кольцевом буфере, чтобы по запросу
+    показать самые медленные из них с разбивкой по этапам.
+    """
+
+    def __init__(self, capacity: int):
+        self._recent: deque = deque(maxlen=capacity)
+
+    @contextmanager
+    def trace(self, name: str, **attrs) -> Iterator[Trace]:
+        trace = Trace(name, attrs)
+        token = _current.set((trace, ()))
+        started = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            trace.duration = time.perf_counter() - started
+            _current.reset(token)
+            self._recent.append(trace)
+
+    def slowest(self, limit: int = 5, **attrs) -> List[Trace]:
+        """Самые долгие из последних задач, у которых совпадают указанные атрибуты."""
+        matching = (t for t in self._recent if all(t.attrs.get(key) == value for key, value in attrs.items()))
+        return heapq.nlargest(limit, matching, key=lambda t: t.duration)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Замеряет этап текущей задачи; вне задачи ничего не делает."""
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    trace, parent = current
+    path = parent + (name,)
+    token = _current.set((trace, path))
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        trace.add_span(path, time.perf_counter() - started)
+
+
+def traced(name: str):
+    """Декоратор для корутин: весь вызов записывается как этап name."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attrs):
+    """Добавляет атрибуты (например, id поста) к текущей задаче."""
+    current = _current.get()
+    if current is not None:
+        current[0].attrs.update(attrs)
+
+
+tracer = Tracer(capacity=performance_config.trace_buffer_size)
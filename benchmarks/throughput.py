@@ -0,0 +1,367 @@
+# benchmarks/throughput.py
+"""
+Офлайн-бенчмарк пропускной способности: поднимает в отдельном процессе поддельные
+e621, Rule34 (dapi), CDN с медиа и Telegram Bot API, заводит N каналов во временной
+базе и гоняет их через настоящий диспетчер, posting_job и send_media.
+
+Запуск из корня репозитория:
+    python benchmarks/throughput.py --channels 200 --duration 180
+
+Отчет: посты в минуту, p50/p99 длительности задачи и опоздания старта, загрузка CPU
+и память процесса бота (поддельные серверы работают в другом процессе и не учитываются).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+TOTAL_POSTS = 1_000_000
+RULE34_COUNT = 150_000
+PAGE_SIZE = 100
+EXTENSIONS = ("jpg", "png", "jpg", "gif", "mp4")
+
+
+# --- Fake servers (run in a child process) ---
+
+def _pick_ext(post_id: int, webm_ratio: float) -> str:
+    if webm_ratio and (post_id * 2654435761 % 1000) / 1000 < webm_ratio:
+        return "webm"
+    return EXTENSIONS[post_id % len(EXTENSIONS)]
+
+
+def _e621_post(base: str, post_id: int, webm_ratio: float) -> Dict:
+    ext = _pick_ext(post_id, webm_ratio)
+    created = datetime.fromtimestamp(1_600_000_000 + post_id * 90, tz=timezone.utc)
+    return {
+        "id": post_id,
+        "file": {"url": f"{base}/cdn/{post_id}.{ext}", "ext": ext, "md5": f"{post_id:032x}"},
+        "tags": {"general": ["benchmark", f"tag{post_id % 50}"]},
+        "score": {"total": post_id % 300},
+        "created_at": created.isoformat(),
+    }
+
+
+def _rule34_post(base: str, post_id: int, webm_ratio: float) -> Dict:
+    ext = _pick_ext(post_id, webm_ratio)
+    return {
+        "id": post_id, "file_url": f"{base}/cdn/{post_id}.{ext}", "image": f"{post_id}.{ext}",
+        "tags": f"benchmark tag{post_id % 50}", "score": post_id % 300, "hash": f"{post_id:032x}",
+        "change": 1_600_000_000 + post_id * 90,
+    }
+
+
+def _page_ids(top: int, page: int, total: int) -> List[int]:
+    first = top - page * PAGE_SIZE
+    return [i for i in range(first, first - PAGE_SIZE, -1) if i > top - total and i > 0]
+
+
+def make_sample_webm(path: Path, seconds: float) -> bytes:
+    """Короткое настоящее WEBM-видео, чтобы бенчмарк проходил через реальную конвертацию."""
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"testsrc=duration={seconds}:size=640x360:rate=24",
+         "-c:v", "libvpx", "-b:v", "500k", str(path)],
+        check=True,
+    )
+    return path.read_bytes()
+
+
+def build_fake_app(api_latency: float, telegram_latency: float, webm_ratio: float, media_kb: int,
+                   webm: Optional[bytes] = None) -> web.Application:
+    stats = {"e621": 0, "rule34": 0, "cdn": 0, "telegram": {}, "channel_posts": 0}
+    media = os.urandom(media_kb * 1024)
+    message_ids = iter(range(1, 1 << 62))
+
+    def base(request: web.Request) -> str:
+        return f"http://{request.host}"
+
+    async def e621(request: web.Request) -> web.Response:
+        stats["e621"] += 1
+        await asyncio.sleep(api_latency)
+        page = request.query.get("page", "1")
+        tags = request.query.get("tags", "")
+        if page.startswith("a"):
+            after = int(page[1:])
+            ids = [i for i in range(after + PAGE_SIZE, after, -1) if i <= TOTAL_POSTS]
+        elif page.startswith("b"):
+            before = int(page[1:])
+            ids = [i for i in range(before - 1, before - 1 - PAGE_SIZE, -1) if i > 0]
+        elif "order:random" in tags:
+            ids = random.sample(range(1, TOTAL_POSTS + 1), PAGE_SIZE)
+        else:
+            ids = _page_ids(TOTAL_POSTS, int(page) - 1, TOTAL_POSTS)
+        return web.json_response({"posts": [_e621_post(base(request), i, webm_ratio) for i in ids]})
+
+    async def rule34(request: web.Request) -> web.Response:
+        stats["rule34"] += 1
+        await asyncio.sleep(api_latency)
+        if request.query.get("limit") == "0":
+            return web.Response(text=f'<?xml version="1.0" encoding="UTF-8"?><posts count="{RULE34_COUNT}" offset="0"></posts>',
+                                content_type="text/xml")
+        tags = request.query.get("tags", "")
+        top = TOTAL_POSTS
+        for tag in tags.split():
+            if tag.startswith("id:>"):
+                after = int(tag[4:])
+                ids = [i for i in range(after + 1, after + 1 + PAGE_SIZE) if i <= top]
+                break
+            if tag.startswith("id:<"):
+                top = int(tag[4:]) - 1
+        else:
+            ids = _page_ids(top, int(request.query.get("pid", 0)), RULE34_COUNT)
+        return web.json_response([_rule34_post(base(request), i, webm_ratio) for i in ids])
+
+    async def cdn(request: web.Request) -> web.Response:
+        stats["cdn"] += 1
+        # Other formats are never decoded by the bot, random bytes are enough for them
+        body = webm if webm is not None and request.match_info["name"].endswith(".webm") else media
+        headers = {"Content-Length": str(len(body))}
+        if request.method == "HEAD":
+            return web.Response(headers=headers)
+        return web.Response(body=body, content_type="application/octet-stream")
+
+    async def telegram(request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        stats["telegram"][method] = stats["telegram"].get(method, 0) + 1
+        form = await request.post()
+        await asyncio.sleep(telegram_latency)
+        chat_id = int(form.get("chat_id", 0))
+        if chat_id < 0 and method != "sendMessage":
+            stats["channel_posts"] += 1
+        message_id = next(message_ids)
+        file = {"file_id": f"file{message_id}", "file_unique_id": f"u{message_id}"}
+        result = {"message_id": message_id, "date": int(time.time()),
+                  "chat": {"id": chat_id, "type": "channel" if chat_id < 0 else "private"}}
+        if method == "sendPhoto":
+            result["photo"] = [{**file, "width": 800, "height": 600}]
+        elif method == "sendAnimation":
+            result["animation"] = {**file, "width": 400, "height": 300, "duration": 3}
+        elif method == "sendVideo":
+            result["video"] = {**file, "width": 1280, "height": 720, "duration": 10}
+        elif method == "sendDocument":
+            result["document"] = file
+        else:
+            result["text"] = form.get("text", "")
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_get("/posts.json", e621)
+    app.router.add_get("/index.php", rule34)
+    app.router.add_route("*", "/cdn/{name}", cdn)
+    app.router.add_post("/bot{token}/{method}", telegram)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+def run_fake_servers(port_queue: multiprocessing.Queue, api_latency: float, telegram_latency: float, webm_ratio: float, media_kb: int,
+                     webm: Optional[bytes] = None):
+    async def serve():
+        runner = web.AppRunner(build_fake_app(api_latency, telegram_latency, webm_ratio, media_kb, webm), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port_queue.put(site._server.sockets[0].getsockname()[1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+# --- Benchmark driver ---
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run_benchmark(args: argparse.Namespace, base_url: str) -> Dict:
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    from app.database import db_manager
+    from app.middlewares.send_rate_limiter import SendRateLimiter
+    from app.services import scheduler as posting
+    from app.services.api_client import E621Client, Rule34Client
+    from app.services.dispatcher import dispatcher
+    from app.services.host_limiter import host_limiters
+    from app.services.http_client import close_http_session, init_http_session
+    from app.services.transcoder import transcoder
+
+    E621Client.API_URL = f"{base_url}/posts.json"
+    Rule34Client.API_URL = f"{base_url}/index.php"
+    if args.api_rate:
+        for limiter in host_limiters.values():
+            limiter.bucket.rate = limiter.bucket.capacity = args.api_rate
+
+    db_manager.db_pool.db_path = str(Path(args.workdir) / "benchmark.db")
+    await db_manager.init_db()
+    # Creates temp_media/ in the working directory, as on bot startup
+    await posting.cleanup_temp_media()
+    await init_http_session()
+    bot = Bot("42:benchmark", session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+    bot.session.middleware(SendRateLimiter())
+
+    priorities = ("random", "random", "newest", "most_popular")
+    durations: List[float] = []
+    lateness: List[float] = []
+
+    def timed(job, interval_seconds: float, phase_start: datetime):
+        async def run(*job_args):
+            started = time.monotonic()
+            now = datetime.now(timezone.utc)
+            due = phase_start.timestamp() + (now.timestamp() - phase_start.timestamp()) // interval_seconds * interval_seconds
+            lateness.append(now.timestamp() - due)
+            try:
+                await job(*job_args)
+            finally:
+                durations.append(time.monotonic() - started)
+        return run
+
+    for n in range(args.channels):
+        admin_id, channel_id = 1000 + n % args.admins, -1_000_000_000_000 - n
+        await db_manager.add_channel(admin_id, channel_id)
+        settings = {
+            "api_source": "e621" if n % 2 == 0 else "rule34",
+            "tags": f"benchmark query{n % max(1, args.distinct_queries)}",
+            "post_priority": priorities[n % len(priorities)],
+            "post_interval_minutes": args.interval,
+            "is_active": 1,
+        }
+        for key, value in settings.items():
+            await db_manager.update_channel_setting(admin_id, channel_id, key, value)
+        await posting.add_posting_job(dispatcher, bot, admin_id, channel_id, args.interval)
+        job = dispatcher.get_job(f"job_{admin_id}_{channel_id}")
+        phase = posting.channel_phase_seconds(admin_id, channel_id, args.interval)
+        # Wrapped after registration so the dispatcher runs the real posting_job underneath
+        job.func = timed(job.func, args.interval * 60, posting.PHASE_EPOCH + timedelta(seconds=phase))
+
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+    wall_started = time.monotonic()
+    transcoder.start()
+    dispatcher.start()
+    await asyncio.sleep(args.duration)
+    wall = time.monotonic() - wall_started
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+    rss = current_rss_mb()
+
+    await dispatcher.shutdown()
+    await transcoder.stop()
+    await bot.session.close()
+    async with aiohttp.ClientSession() as client:
+        async with client.get(f"{base_url}/stats") as response:
+            server_stats = await response.json()
+    await close_http_session()
+    await db_manager.close_db()
+
+    cpu_seconds = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+    return {
+        "channels": args.channels,
+        "duration_seconds": round(wall, 1),
+        "channel_posts": server_stats["channel_posts"],
+        "posts_per_minute": round(server_stats["channel_posts"] / wall * 60, 1),
+        "expected_posts_per_minute": round(args.channels / args.interval, 1),
+        "jobs_finished": len(durations),
+        "job_seconds_p50": round(percentile(durations, 50), 3),
+        "job_seconds_p99": round(percentile(durations, 99), 3),
+        "start_lateness_p50": round(percentile(lateness, 50), 3),
+        "start_lateness_p99": round(percentile(lateness, 99), 3),
+        "cpu_percent": round(cpu_seconds / wall * 100, 1),
+        "rss_mb": round(rss, 1),
+        "peak_rss_mb": round(cpu_after.ru_maxrss / 1024, 1),
+        "api_requests": {"e621": server_stats["e621"], "rule34": server_stats["rule34"]},
+        "cdn_requests": server_stats["cdn"],
+        "telegram_requests": server_stats["telegram"],
+        "dispatcher": dispatcher.stats(),
+        "transcoder": transcoder.stats(),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark with fake booru and Bot API servers.")
+    parser.add_argument("--channels", type=int, default=100, help="number of synthetic channels")
+    parser.add_argument("--admins", type=int, default=5, help="admins the channels are spread across")
+    parser.add_argument("--distinct-queries", type=int, default=30, help="distinct tag queries shared by the channels")
+    parser.add_argument("--interval", type=int, default=1, help="posting interval of every channel, minutes")
+    parser.add_argument("--duration", type=float, default=180, help="how long to run, seconds")
+    parser.add_argument("--api-latency-ms", type=float, default=80, help="fake booru API response delay")
+    parser.add_argument("--telegram-latency-ms", type=float, default=120, help="fake Bot API response delay")
+    parser.add_argument("--api-rate", type=float, default=0, help="override per-host API request rate (0 = configured)")
+    parser.add_argument("--webm-ratio", type=float, default=0.0, help="share of webm posts (needs ffmpeg)")
+    parser.add_argument("--webm-seconds", type=float, default=4, help="length of the sample webm served by the fake CDN")
+    parser.add_argument("--media-kb", type=int, default=256, help="size of every media file served by the fake CDN")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    webm = None
+    if args.webm_ratio > 0:
+        if not shutil.which("ffmpeg"):
+            sys.exit("--webm-ratio needs ffmpeg to generate the sample video and to transcode it.")
+        with tempfile.TemporaryDirectory(prefix="bench_webm_") as sample_dir:
+            webm = make_sample_webm(Path(sample_dir) / "sample.webm", args.webm_seconds)
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=run_fake_servers, daemon=True,
+        args=(port_queue, args.api_latency_ms / 1000, args.telegram_latency_ms / 1000, args.webm_ratio, args.media_kb, webm),
+    )
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+    repo_root = Path(__file__).resolve().parent.parent
+    with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+        args.workdir = workdir
+        # temp_media/ and the media cache are relative paths
+        os.chdir(workdir)
+        try:
+            report = asyncio.run(run_benchmark(args, base_url))
+        finally:
+            os.chdir(repo_root)
+            server.terminate()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(f"{key:>26}: {value}")
+
+
+if __name__ == "__main__":
+    main()
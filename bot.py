@@ -1,21 +1,29 @@
 import asyncio
 import logging
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import coloredlogs
 
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from app.config_reader import config, admin_config
-from app.database.db_manager import init_db, get_all_active_channels
+from app.config_reader import config, admin_config, performance_config
+from app.database.db_manager import init_db, close_db, get_all_active_channels
 from app.handlers import admin_private, callbacks
 from app.middlewares.logging_middleware import LoggingMiddleware
 from app.middlewares.error_middleware import ErrorMiddleware
 from app.middlewares.throttling_middleware import ThrottlingMiddleware
-from app.services.scheduler import posting_job, check_dependencies, cleanup_temp_media
+from app.middlewares.send_rate_limiter import SendRateLimiter
+from app.services.http_client import init_http_session, close_http_session
+from app.services.dispatcher import PostingDispatcher, dispatcher
+from app.services.scheduler import add_posting_job, check_dependencies, cleanup_temp_media
+from app.services.transcoder import transcoder
 from app.utils.commands import set_commands
+from app.utils.log_sampling import SamplingFilter
+from app.utils.metrics import start_metrics_server, stop_metrics_server
+
+_log_listener = None
 
 
 def setup_logging():
@@ -38,16 +46,42 @@ def setup_logging():
     file_handler = RotatingFileHandler('logs/bot.log', maxBytes=5*1024*1024, backupCount=5, encoding='utf-8')
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(logging.Formatter(log_format))
-    root_logger.addHandler(file_handler)
 
     # Configure stream handler for console
-    coloredlogs.install(level='INFO', fmt=log_format, logger=root_logger, stream=sys.stdout)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(coloredlogs.ColoredFormatter(fmt=log_format))
+
+    # File and console writes happen on the listener's thread, the event loop only enqueues records
+    global _log_listener
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    if performance_config.log_sample_burst > 0:
+        queue_handler.addFilter(SamplingFilter(performance_config.log_sample_burst, performance_config.log_sample_window_seconds))
+    root_logger.addHandler(queue_handler)
+    _log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _log_listener.start()
+
+    for name, level in performance_config.log_levels.items():
+        try:
+            logging.getLogger(name).setLevel(level.upper() if isinstance(level, str) else level)
+        except (TypeError, ValueError) as e:
+            # A typo in the config shouldn't keep the bot from starting
+            logging.error(f"Ignoring invalid log level {level!r} for logger '{name}' in performance.log_levels: {e}")
 
     logging.info("Logging setup complete.")
 
 
+def stop_logging():
+    global _log_listener
+    if _log_listener is not None:
+        # Flushes the records still in the queue
+        _log_listener.stop()
+        _log_listener = None
+
+
 async def setup_scheduler(bot: Bot):
-    scheduler = AsyncIOScheduler(timezone="UTC")
+    scheduler = dispatcher
     if not admin_config.admin_ids:
         logging.warning("No admin IDs configured. Scheduler will not be started.")
         return scheduler
@@ -55,16 +89,14 @@ async def setup_scheduler(bot: Bot):
     active_channels = await get_all_active_channels()
     for channel_settings in active_channels:
         if channel_settings['admin_id'] in admin_config.admin_ids:
-            scheduler.add_job(
-                posting_job, "interval", minutes=channel_settings['post_interval_minutes'],
-                args=[bot, channel_settings['admin_id'], channel_settings['channel_id'], scheduler], 
-                id=f"job_{channel_settings['admin_id']}_{channel_settings['channel_id']}"
+            await add_posting_job(
+                scheduler, bot, channel_settings['admin_id'], channel_settings['channel_id'],
+                channel_settings['post_interval_minutes']
             )
-            logging.info(f"Scheduled job for admin {channel_settings['admin_id']} and channel {channel_settings['channel_id']} every {channel_settings['post_interval_minutes']} minutes.")
     return scheduler
 
 
-def setup_dispatcher(scheduler: AsyncIOScheduler):
+def setup_dispatcher(scheduler: PostingDispatcher):
     dp = Dispatcher(storage=MemoryStorage())
     dp['admin_ids'] = admin_config.admin_ids
     dp['scheduler'] = scheduler
@@ -104,16 +136,31 @@ async def main():
         return
 
     bot = Bot(token=config.bot_token.get_secret_value())
+    # Every outgoing message goes through the session, so this is the single place to pace them
+    bot.session.middleware(SendRateLimiter(
+        global_rate=performance_config.telegram_global_rate,
+        chat_rate=performance_config.telegram_chat_rate,
+        group_per_minute=performance_config.telegram_group_per_minute,
+        max_retries=performance_config.telegram_retry_after_attempts,
+    ))
+    await init_http_session()
     scheduler = await setup_scheduler(bot)
     dp = setup_dispatcher(scheduler)
 
     try:
         scheduler.start()
+        transcoder.start()
+        if performance_config.metrics_port:
+            await start_metrics_server(performance_config.metrics_host, performance_config.metrics_port)
         await on_startup(bot)
         await dp.start_polling(bot)
     finally:
-        scheduler.shutdown()
+        await stop_metrics_server()
+        await scheduler.shutdown()
+        await transcoder.stop()
         await bot.session.close()
+        await close_http_session()
+        await close_db()
 
 
 if __name__ == "__main__":
@@ -121,3 +168,5 @@ if __name__ == "__main__":
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logging.info("Bot stopped.")
+    finally:
+        stop_logging()